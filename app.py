@@ -1,34 +1,40 @@
 import os
+import sys
 import logging
 import uvicorn
+import anyio.to_thread
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from starlette.responses import FileResponse
-from fastapi.templating import Jinja2Templates
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# Configure logging before the route imports, so db_client's startup messages use it.
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
 
 # Routes Import
 from routes.main import router as main_router
-from routes.auth import router as auth_router
+from routes.auth import router as auth_router, close_http_client
 from routes.dashboard import router as dashboard_router
-from routes.clusters import router as clusters_router
+from routes.clusters import router as clusters_router, shutdown_gsc_executor
 from routes.global_exception_handler import register_global_exception_handlers
 
 # Import the custom Mongo-based session middleware
-from mongo_session import MongoSessionMiddleware
+from mongo_session import MongoSessionMiddleware, start_session_flusher, stop_session_flusher
 
 # Import your db_client if needed
-from db_client import client
+from db_client import client, start_index_audit, stop_index_audit
 
 # Import the flash helpers
-from routes.flash import flash, get_flashed_messages
+from routes.flash import FlashCookieMiddleware, flash, get_flashed_messages
+
+# Shared Jinja2 templates (configured in routes/utils.py)
+from routes.utils import templates
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
 logger = logging.getLogger(__name__)
 logger.info("Starting FastAPI with Mongo session...")
 
@@ -42,8 +48,10 @@ else:
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '0'  # Ensure secure transport in production.
 
 # Create FastAPI app instance with custom title and docs URLs.
+# JSON responses are serialized with orjson.
 app = FastAPI(
     title="Apimio Google Console Tracker",
+    default_response_class=ORJSONResponse,
     docs_url="/docs",
     redoc_url="/redoc"
 )
@@ -52,14 +60,19 @@ app = FastAPI(
 register_global_exception_handlers(app)
 
 # Custom middleware to override the scheme based on the X-Forwarded-Proto header.
-class CustomHTTPSMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
+class CustomHTTPSMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         # If X-Forwarded-Proto header is present, update the request scope scheme.
-        forwarded_proto = request.headers.get("X-Forwarded-Proto")
-        if forwarded_proto:
-            request.scope["scheme"] = forwarded_proto
-        response = await call_next(request)
-        return response
+        if scope["type"] == "http":
+            for key, value in scope["headers"]:
+                if key == b"x-forwarded-proto":
+                    if value:
+                        scope["scheme"] = value.decode("latin-1")
+                    break
+        await self.app(scope, receive, send)
 
 # Add the custom HTTPS middleware
 app.add_middleware(CustomHTTPSMiddleware)
@@ -67,16 +80,16 @@ app.add_middleware(CustomHTTPSMiddleware)
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Configure Jinja2 templates (point to your actual templates directory)
-templates = Jinja2Templates(directory="templates")
-
 # Add custom Mongo-based session middleware
 app.add_middleware(MongoSessionMiddleware)
 
+# Flash messages are carried in their own cookie (see routes/flash.py)
+app.add_middleware(FlashCookieMiddleware)
+
 def render_template(request: Request, template_name: str, context: dict = {}):
     """
     Helper function to render templates.
-    It automatically injects flash messages from the session into the context.
+    It automatically injects the pending flash messages into the context.
     """
     context.update({
         "request": request,
@@ -90,15 +103,44 @@ app.include_router(auth_router, prefix="/auth")
 app.include_router(dashboard_router, prefix="/dashboard")
 app.include_router(clusters_router)
 
+# Sync route handlers (and their blocking PyMongo / Google API calls) run in the
+# anyio threadpool, which defaults to 40 threads per worker.
+THREADPOOL_MAX_WORKERS = int(os.getenv("THREADPOOL_MAX_WORKERS", 100))
+
+# Size the threadpool, start the background writer that batches session saves and the index audit
+@app.on_event("startup")
+async def startup_background_workers():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_MAX_WORKERS
+    start_session_flusher()
+    start_index_audit()
+
+# Flush pending session writes, release pooled outbound HTTP connections and stop GSC jobs on shutdown
+@app.on_event("shutdown")
+async def shutdown_background_clients():
+    await stop_index_audit()
+    await stop_session_flusher()
+    await close_http_client()
+    shutdown_gsc_executor()
+
+# Health-check and favicon responses are built once and returned as-is,
+# skipping response serialization (and the file stat for the favicon) per request.
+HEALTH_RESPONSE = Response(content=b'{"status":"ok"}', media_type="application/json")
+with open("static/favicon.ico", "rb") as favicon_file:
+    FAVICON_RESPONSE = Response(
+        content=favicon_file.read(),
+        media_type="image/x-icon",
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
+
 # Add a simple health-check endpoint
 @app.get("/health", tags=["Health"])
-def health_check():
-    return {"status": "ok"}
+async def health_check():
+    return HEALTH_RESPONSE
 
 # Serve the favicon
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
-    return FileResponse("static/favicon.ico")
+    return FAVICON_RESPONSE
 
 @app.get("/check_headers")
 async def check_headers(request: Request):
@@ -113,11 +155,17 @@ async def check_headers(request: Request):
 # Run uvicorn programmatically with proxy headers enabled
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
+    reload = (ENV == "development")
     uvicorn.run(
         "app:app",
         host="0.0.0.0",
         port=port,
-        reload=(ENV == "development"),
+        reload=reload,
+        # uvicorn ignores workers when reloading, so only use WEB_CONCURRENCY outside development.
+        workers=1 if reload else int(os.getenv("WEB_CONCURRENCY", 1)),
         proxy_headers=True,
-        forwarded_allow_ips="*"
+        forwarded_allow_ips="*",
+        # libuv event loop and C HTTP parser; uvloop is not available on Windows.
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools"
     )
@@ -1,9 +1,15 @@
 import os
+import asyncio
 import logging
 import warnings
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 from pymongo.server_api import ServerApi
+from pymongo.topology_description import TOPOLOGY_TYPE
 from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
 
 # Ignore specific warnings.
 warnings.filterwarnings(
@@ -11,8 +17,7 @@ warnings.filterwarnings(
     message="file_cache is only supported with oauth2client<4.0.0"
 )
 
-# Configure logging for the module.
-logging.basicConfig(level=logging.INFO)
+# Module logger; handlers and level are configured once in app.py.
 logger = logging.getLogger(__name__)
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
@@ -25,27 +30,253 @@ if not uri:
     logger.error("MONGODB_URI environment variable not set.")
     raise EnvironmentError("MONGODB_URI environment variable not set.")
 
+# Connection pool bounds per process. Each uvicorn worker has its own pool, so the
+# server sees up to WEB_CONCURRENCY * MONGODB_MAX_POOL_SIZE connections. The max
+# matches the default handler threadpool (THREADPOOL_MAX_WORKERS in app.py).
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 10))
+# Close connections idle for 5 minutes; fail a checkout after 2s rather than queueing indefinitely.
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", 300_000))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 2000))
+
+# Trashed clusters, links and performance rows are purged by MongoDB this long after deletedAt.
+TRASH_RETENTION_DAYS = int(os.getenv("TRASH_RETENTION_DAYS", 30))
+
+def utc_now() -> datetime:
+    """
+    Current UTC time as a naive datetime, the form PyMongo stores and returns
+    (the client is not tz_aware). Replaces the deprecated datetime.utcnow().
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def run_migration_once(db, name: str, migrate):
+    """
+    Runs migrate() unless the migrations collection records that it already ran
+    against this database, then records it. The data backfills are full collection
+    scans, so they must not run on every startup of every worker. Workers starting
+    together may both run a migration; they are written to be idempotent.
+    """
+    if db.migrations.find_one({"_id": name}, {"_id": 1}):
+        return
+    logger.info("Running migration %s", name)
+    migrate()
+    db.migrations.update_one({"_id": name}, {"$setOnInsert": {"appliedAt": utc_now()}}, upsert=True)
+    logger.info("Migration %s applied", name)
+
+def create_unique_index(coll, keys, description: str, **kwargs) -> str:
+    """
+    Creates a unique index over keys. Handlers rely on it as their duplicate check,
+    so when existing documents already share a key the duplicates are logged and
+    startup fails, rather than the app running without the guarantee.
+    """
+    try:
+        return coll.create_index(keys, unique=True, **kwargs)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        duplicates = coll.aggregate([
+            {"$match": kwargs.get("partialFilterExpression", {})},
+            {"$group": {"_id": {field: f"${field}" for field, _ in keys}, "ids": {"$push": "$_id"}}},
+            {"$match": {"ids.1": {"$exists": True}}}
+        ])
+        for dup in duplicates:
+            logger.error("Duplicate %s for %s: %s", coll.name, dup["_id"], dup["ids"])
+        raise RuntimeError(
+            f"Unique index on {description} not created: the documents logged above share "
+            "a key. Rename or delete all but one of each and restart."
+        ) from e
+
 client = None
 try:
-    # Initialize the MongoDB client with the server API version.
-    client = MongoClient(uri, server_api=ServerApi('1'))
+    # Initialize the MongoDB client with the server API version, a bounded pool kept
+    # warm between bursts, and wire compression (zstd via the zstandard package, else zlib).
+    client = MongoClient(
+        uri,
+        server_api=ServerApi('1'),
+        maxPoolSize=MONGODB_MAX_POOL_SIZE,
+        minPoolSize=MONGODB_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+        waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        compressors="zstd,zlib"
+    )
     # Ping the server to verify a successful connection.
     client.admin.command('ping')
     logger.info("Pinged your MongoDB deployment. Connected successfully!")
+
+    # MongoClient.bulk_write (one bulkWrite command across collections) needs
+    # MongoDB 8.0+, i.e. wire version 25.
+    SUPPORTS_CLIENT_BULK_WRITE = client.admin.command('hello').get('maxWireVersion', 0) >= 25
     
     # Access the target database.
     db = client['apimio']
     # Access the 'link_performance' collection.
     collection = db.link_performance
 
-    # Create a compound index on (linkId, date, deleted).
-    index_name = collection.create_index([
-        ("linkId", 1),
-        ("date", 1),
-        ("deleted", 1)
-    ])
-    logger.info("Index created successfully on (linkId, date, deleted): %s", index_name)
+    # Soft-delete filters match on deleted=False, so make sure every link and
+    # performance document carries the field (older upserts did not set it).
+    def backfill_deleted():
+        for coll in (db.links, db.link_performance):
+            coll.update_many({"deleted": {"$exists": False}}, {"$set": {"deleted": False}})
+    run_migration_once(db, "backfill_deleted", backfill_deleted)
+
+    # Index for a cluster's active or trashed links.
+    index_name = db.links.create_index([("clusterId", 1), ("deleted", 1)])
+    logger.info("Index created successfully on links (clusterId, deleted): %s", index_name)
+
+    # One active link per URL within a cluster; trashed links may share the URL.
+    index_name = create_unique_index(
+        db.links,
+        [("clusterId", 1), ("url", 1)],
+        "active links (clusterId, url)",
+        partialFilterExpression={"deleted": False}
+    )
+    logger.info("Unique index created successfully on active links (clusterId, url): %s", index_name)
+
+    # Index for a link's active rows over a date range, newest first (equality keys
+    # before the range / sort key, so the sort needs no in-memory stage), and for
+    # soft-deleting / restoring all performance rows of a set of links. It replaces
+    # the former (linkId, deleted) index, which is its prefix, and the former
+    # (linkId, date, deleted) index, whose queries it serves as well.
+    index_name = collection.create_index([("linkId", 1), ("deleted", 1), ("date", 1)])
+    logger.info("Index created successfully on (linkId, deleted, date): %s", index_name)
+    existing_indexes = collection.index_information()
+    for superseded in ("linkId_1_deleted_1", "linkId_1_date_1_deleted_1"):
+        if superseded in existing_indexes:
+            collection.drop_index(superseded)
+            logger.info("Dropped superseded index %s on link_performance", superseded)
+
+    # Performance rows carry their link's clusterId so cluster-wide trash / restore / delete
+    # is a single update keyed on the cluster. Backfill rows written before the field existed,
+    # server-side: look up each row's link and merge its clusterId back into the row.
+    run_migration_once(db, "backfill_link_performance_cluster_id", lambda: collection.aggregate([
+        {"$match": {"clusterId": {"$exists": False}}},
+        {"$lookup": {"from": "links", "localField": "linkId", "foreignField": "_id", "as": "link"}},
+        {"$unwind": "$link"},
+        {"$project": {"clusterId": "$link.clusterId"}},
+        {"$merge": {"into": "link_performance", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ]))
+
+    # Index for soft-deleting / restoring / removing all performance rows of a cluster,
+    # and for the cluster's active rows over a date range.
+    index_name = collection.create_index([("clusterId", 1), ("deleted", 1), ("date", 1)])
+    logger.info("Index created successfully on (clusterId, deleted, date): %s", index_name)
+
+    # updatedAt is rewritten by nearly every link and performance write and no query
+    # filters or sorts on it, so an index over it (e.g. one added by hand) would only
+    # add index maintenance to those writes. Drop any such index.
+    for coll in (db.links, db.link_performance):
+        for name, info in coll.index_information().items():
+            if any(field == "updatedAt" for field, _ in info["key"]):
+                coll.drop_index(name)
+                logger.info("Dropped index %s on %s: it covers the frequently written updatedAt", name, coll.name)
+
+    # Unique cluster names per user and domain. Trashed clusters keep their name reserved
+    # (they can be restored), so the index covers them too.
+    index_name = create_unique_index(
+        db.clusters,
+        [("userId", 1), ("domain", 1), ("clusterName", 1)],
+        "clusters (userId, domain, clusterName)"
+    )
+    logger.info("Unique index created successfully on clusters (userId, domain, clusterName): %s", index_name)
+
+    # Index for listing a domain's active or trashed clusters.
+    index_name = db.clusters.create_index([("userId", 1), ("domain", 1), ("deleted", 1)])
+    logger.info("Index created successfully on clusters (userId, domain, deleted): %s", index_name)
+
+    # Index for the properties sync, which upserts a user's domain properties by siteUrl.
+    index_name = db.domain_properties.create_index([("userId", 1), ("siteUrl", 1)])
+    logger.info("Index created successfully on domain_properties (userId, siteUrl): %s", index_name)
+
+    # Trash retention: TTL indexes over deletedAt, limited to trashed documents, let
+    # MongoDB's TTL monitor purge them in the background. Restoring a document clears
+    # deletedAt, which takes it back out of the index. A changed retention is applied
+    # to the existing index with collMod.
+    for coll in (db.clusters, db.links, db.link_performance):
+        try:
+            index_name = coll.create_index(
+                "deletedAt",
+                name="trash_ttl",
+                expireAfterSeconds=TRASH_RETENTION_DAYS * 86400,
+                partialFilterExpression={"deleted": True}
+            )
+        except OperationFailure as e:
+            if e.code != 85:  # IndexOptionsConflict
+                raise
+            db.command("collMod", coll.name, index={"name": "trash_ttl", "expireAfterSeconds": TRASH_RETENTION_DAYS * 86400})
+            index_name = "trash_ttl"
+        logger.info("TTL index created successfully on %s.deletedAt (%d days): %s", coll.name, TRASH_RETENTION_DAYS, index_name)
+
+    # Unique index on users.email; the OAuth callback upserts users by email.
+    index_name = db.users.create_index("email", unique=True)
+    logger.info("Unique index created successfully on users.email: %s", index_name)
+
+    # Create a TTL index so Mongo purges expired sessions on its own.
+    index_name = db.fastapi_sessions.create_index("expiresAt", expireAfterSeconds=0)
+    logger.info("TTL index created successfully on fastapi_sessions.expiresAt: %s", index_name)
 
 except Exception as e:
     logger.error("Error connecting to MongoDB: %s", e, exc_info=True)
     raise e
+
+
+def run_in_transaction(callback):
+    """
+    Runs callback(session) inside a transaction so its writes commit together.
+    Transactions need a replica set or sharded cluster; on a standalone server
+    the callback runs with session=None and its writes are applied one by one.
+    """
+    if client.topology_description.topology_type == TOPOLOGY_TYPE.Single:
+        return callback(None)
+    with client.start_session() as session:
+        return session.with_transaction(callback)
+
+
+# Periodic audit of the write-heavy collections' indexes: each unused index slows
+# every write, so indexes with no recorded use for a day are logged for review.
+INDEX_AUDIT_INTERVAL_SECONDS = int(os.getenv("INDEX_AUDIT_INTERVAL_SECONDS", 3600))
+INDEX_UNUSED_AFTER = timedelta(hours=24)
+_index_audit_task: Optional[asyncio.Task] = None
+
+def log_unused_indexes():
+    """
+    Logs the secondary indexes on links and link_performance that $indexStats reports
+    no operations for since at least INDEX_UNUSED_AFTER ago. Unique and TTL indexes are
+    skipped: they enforce constraints or expiry even when no query uses them. The counters restart with
+    mongod, so nothing is reported in the first INDEX_UNUSED_AFTER after a restart.
+    """
+    cutoff = utc_now() - INDEX_UNUSED_AFTER
+    for coll in (db.links, db.link_performance):
+        for stats in coll.aggregate([
+            {"$indexStats": {}},
+            {"$project": {"name": 1, "accesses": 1, "spec.unique": 1, "spec.expireAfterSeconds": 1}}
+        ]):
+            spec = stats.get("spec", {})
+            if stats["name"] == "_id_" or spec.get("unique") or "expireAfterSeconds" in spec:
+                continue
+            accesses = stats["accesses"]
+            if accesses["ops"] == 0 and accesses["since"] < cutoff:
+                logger.warning("Index %s on %s has not been used since %s; consider dropping it.",
+                               stats["name"], coll.name, accesses["since"])
+
+async def _index_audit_loop():
+    while True:
+        await asyncio.sleep(INDEX_AUDIT_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(log_unused_indexes)
+        except Exception as e:
+            logger.error("Error auditing index usage: %s", e, exc_info=True)
+
+def start_index_audit():
+    """Start the periodic index usage audit; call from the app startup event."""
+    global _index_audit_task
+    _index_audit_task = asyncio.create_task(_index_audit_loop())
+
+async def stop_index_audit():
+    """Stop the periodic index usage audit; call on app shutdown."""
+    if _index_audit_task is None or _index_audit_task.done():
+        return
+    _index_audit_task.cancel()
+    try:
+        await _index_audit_task
+    except asyncio.CancelledError:
+        pass
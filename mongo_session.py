@@ -1,20 +1,32 @@
-import uuid
+import asyncio
+import copy
+import secrets
+import threading
+import time
+import zlib
+from collections.abc import MutableMapping
 from datetime import datetime, timedelta
 from typing import Optional
 
 import logging
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.types import ASGIApp
+import bson
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from pymongo import UpdateOne, WriteConcern
+from cachetools import TTLCache
 
 # Import your existing Mongo client from db_client.py
-from db_client import client
+from db_client import client, utc_now
 
 logger = logging.getLogger(__name__)
 
 # Store sessions in the "fastapi_sessions" collection
 db = client["apimio"]
 session_collection = db["fastapi_sessions"]
+# Unacknowledged writes for non-critical updates (sliding expiry refresh).
+session_collection_fast = session_collection.with_options(write_concern=WriteConcern(w=0))
 
 # Name of the cookie for session ID
 SESSION_COOKIE_NAME = "session_id"
@@ -22,126 +34,455 @@ SESSION_COOKIE_NAME = "session_id"
 # How long before a session expires (e.g. 7 days)
 SESSION_LIFETIME_DAYS = 7
 
+# Paths that never touch the session (static assets, health checks, API docs) bypass the middleware.
+SESSION_SKIP_PREFIXES = ("/static/", "/health", "/favicon.ico", "/docs", "/redoc", "/openapi.json")
 
-def create_session_doc(session_id: str) -> dict:
-    """Create a new session doc in Mongo with empty data."""
-    now = datetime.utcnow()
-    expires_at = now + timedelta(days=SESSION_LIFETIME_DAYS)
-    doc = {
-        "_id": session_id,
-        "data": {},
-        "expiresAt": expires_at
-    }
-    try:
-        session_collection.insert_one(doc)
-        logger.info("Created new session document for session_id: %s", session_id)
-    except Exception as e:
-        logger.error("Error creating session document: %s", e, exc_info=True)
-        raise HTTPException(status_code=500, detail="Could not create session")
-    return doc
+# Set-Cookie header value, built once; only the session_id is filled in per response.
+# Append "; Secure" to the suffix if using HTTPS.
+_COOKIE_PREFIX = f"{SESSION_COOKIE_NAME}=".encode("latin-1")
+_COOKIE_SUFFIX = f"; Max-Age={SESSION_LIFETIME_DAYS * 24 * 60 * 60}; Path=/; HttpOnly; SameSite=Lax".encode("latin-1")
+
+# The expiry is only pushed forward once less than this remains, so an active
+# session gets about one expiry write per day instead of one per request.
+SESSION_REFRESH_THRESHOLD = timedelta(days=1)
+
+# In-process cache of session docs, so hot sessions skip the Mongo read. Session data
+# is never changed in place (a change is saved under a new session id, see
+# MongoSessionMiddleware), so with several workers a cached doc can only be stale in
+# its expiresAt, by up to this long.
+SESSION_CACHE_TTL_SECONDS = 30
+_session_cache = TTLCache(maxsize=10000, ttl=SESSION_CACHE_TTL_SECONDS)
+_session_cache_lock = threading.Lock()
+
+# Session writes are queued and flushed in batches by a single background task.
+SESSION_FLUSH_INTERVAL_SECONDS = 0.01
+SESSION_FLUSH_MAX_ITEMS = 256
+_save_queue: Optional[asyncio.Queue] = None
+_flusher_task: Optional[asyncio.Task] = None
+
+
+class DirtySessionDict(dict):
+    """
+    Session data dict that remembers whether it was modified,
+    so unchanged sessions are not written back to Mongo.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dirty = False
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._dirty = True
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._dirty = True
+
+    def pop(self, key, *default):
+        if key in self:
+            self._dirty = True
+        return super().pop(key, *default)
+
+    def popitem(self):
+        item = super().popitem()
+        self._dirty = True
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._dirty = True
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._dirty = True
+
+    def clear(self):
+        super().clear()
+        self._dirty = True
+
+
+def new_session_id() -> str:
+    """
+    Generate a session id: a millisecond timestamp prefix followed by 128 random bits, hex encoded.
+    The time prefix keeps new _id values at the right edge of the index instead of scattering them.
+    """
+    return (int(time.time() * 1000).to_bytes(6, "big") + secrets.token_bytes(16)).hex()
+
+
+class LazySession(MutableMapping):
+    """
+    request.state.session: loads the session document on first access, so
+    requests that never touch the session do no Mongo read at all. The load
+    runs wherever the first access happens: in the threadpool for sync routes, on
+    the event loop for async ones, which must call load() through run_in_threadpool
+    before touching the session.
+    A missing or expired document starts a new, empty session with a fresh id.
+    """
+
+    def __init__(self, session_id: Optional[str]):
+        self.session_id = session_id
+        self.expires_at: Optional[datetime] = None
+        self._data: Optional[DirtySessionDict] = None
+        if session_id is None:
+            self._new_session()
+
+    def _new_session(self):
+        self.session_id = new_session_id()
+        self.expires_at = None
+        self._data = DirtySessionDict()
+
+    def load(self) -> DirtySessionDict:
+        if self._data is None:
+            doc = get_session_doc(self.session_id)
+            if doc is None:
+                self._new_session()
+            else:
+                self.expires_at = doc.get("expiresAt", datetime.min)
+                self._data = DirtySessionDict(decode_session_data(doc))
+        return self._data
+
+    @property
+    def loaded(self) -> bool:
+        return self._data is not None
+
+    @property
+    def _dirty(self) -> bool:
+        return self._data is not None and self._data._dirty
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __delitem__(self, key):
+        del self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def __repr__(self):
+        return f"LazySession({self._data!r})" if self.loaded else "LazySession(<not loaded>)"
+
+
+def encode_session_data(data: dict) -> bytes:
+    """
+    Serialize session data to the bytes stored in data_z: BSON, deflated at level 1.
+    The OAuth credentials (tokens, repeated scope URLs) make up most of a session and compress well.
+    """
+    return zlib.compress(bson.encode(data), 1)
+
+
+def decode_session_data(doc: dict) -> dict:
+    """
+    Return a fresh dict of the session data in doc. Sessions are stored as one compressed
+    data_z blob; older documents keep an uncompressed data_blob or a nested data subdocument.
+    """
+    if "data_z" in doc:
+        return bson.decode(zlib.decompress(doc["data_z"]))
+    if "data_blob" in doc:
+        return bson.decode(doc["data_blob"])
+    return copy.deepcopy(doc.get("data", {}))
 
 
 def get_session_doc(session_id: str) -> Optional[dict]:
-    """Fetch existing session doc from Mongo, or None if not found/expired."""
-    try:
-        doc = session_collection.find_one({"_id": session_id})
-    except Exception as e:
-        logger.error("Error retrieving session document for session_id %s: %s", session_id, e, exc_info=True)
-        return None
+    """
+    Fetch existing session doc from the in-process cache or Mongo, or None if not found/expired.
+    The doc may be shared with the cache: read the data through decode_session_data, don't mutate it.
+    """
+    with _session_cache_lock:
+        doc = _session_cache.get(session_id)
 
-    if not doc:
-        logger.info("Session document not found for session_id: %s", session_id)
-        return None
-    if "expiresAt" in doc and doc["expiresAt"] < datetime.utcnow():
-        # Session expired; remove it from the collection.
+    if doc is None:
         try:
-            session_collection.delete_one({"_id": session_id})
-            logger.info("Deleted expired session for session_id: %s", session_id)
+            doc = session_collection.find_one({"_id": session_id})
         except Exception as e:
-            logger.error("Error deleting expired session for session_id %s: %s", session_id, e, exc_info=True)
+            logger.error("Error retrieving session document for session_id %s: %s", session_id, e, exc_info=True)
+            return None
+
+        if not doc:
+            logger.debug("Session document not found for session_id: %s", session_id)
+            return None
+        with _session_cache_lock:
+            _session_cache[session_id] = doc
+
+    if "expiresAt" in doc and doc["expiresAt"] < utc_now():
+        # Session expired; the TTL index on expiresAt removes it in the background,
+        # this check only covers the window before the TTL monitor runs.
+        logger.debug("Session expired for session_id: %s", session_id)
+        with _session_cache_lock:
+            _session_cache.pop(session_id, None)
         return None
     return doc
 
 
-def save_session_doc(session_id: str, data: dict):
-    """Update session doc with new data and reset expiry."""
-    now = datetime.utcnow()
-    expires_at = now + timedelta(days=SESSION_LIFETIME_DAYS)
+def _session_update(blob: bytes, expires_at: Optional[datetime]) -> dict:
+    """
+    Build the update for a session save. Without expires_at the expiry is left alone;
+    it is only set if the upsert creates the document (e.g. it was purged meanwhile).
+    """
+    update = {"$set": {"data_z": bson.Binary(blob)}, "$unset": {"data": "", "data_blob": ""}}
+    if expires_at is None:
+        update["$setOnInsert"] = {"expiresAt": utc_now() + timedelta(days=SESSION_LIFETIME_DAYS)}
+    else:
+        update["$set"]["expiresAt"] = expires_at
+    return update
+
+
+def _cache_session(session_id: str, blob: Optional[bytes], expires_at: Optional[datetime]):
+    """Apply a session save (blob) and/or expiry refresh (expires_at) to the in-process cache."""
+    with _session_cache_lock:
+        doc = _session_cache.get(session_id)
+        if blob is None:
+            if doc is not None:
+                doc["expiresAt"] = expires_at
+        elif expires_at is not None:
+            _session_cache[session_id] = {"_id": session_id, "data_z": blob, "expiresAt": expires_at}
+        elif doc is not None:
+            _session_cache[session_id] = {"_id": session_id, "data_z": blob, "expiresAt": doc.get("expiresAt")}
+
+
+def session_expiry_due(expires_at: Optional[datetime]) -> bool:
+    """True if the session has no stored expiry yet or it runs out within SESSION_REFRESH_THRESHOLD."""
+    return expires_at is None or expires_at < utc_now() + SESSION_REFRESH_THRESHOLD
+
+
+def save_session_doc(session_id: str, data: dict, refresh_expiry: bool = True):
+    """Update session doc with new data and, if refresh_expiry, reset expiry."""
+    expires_at = utc_now() + timedelta(days=SESSION_LIFETIME_DAYS) if refresh_expiry else None
+    blob = encode_session_data(data)
     try:
         session_collection.update_one(
             {"_id": session_id},
-            {"$set": {"data": data, "expiresAt": expires_at}},
+            _session_update(blob, expires_at),
             upsert=True
         )
-        logger.info("Session document updated for session_id: %s", session_id)
+        logger.debug("Session document updated for session_id: %s", session_id)
     except Exception as e:
         logger.error("Error saving session document for session_id %s: %s", session_id, e, exc_info=True)
+        with _session_cache_lock:
+            _session_cache.pop(session_id, None)
         raise HTTPException(status_code=500, detail="Could not save session")
 
+    _cache_session(session_id, blob, expires_at)
+
+
+def delete_session_doc(session_id: str):
+    """Delete a session doc (e.g. one replaced under a new id) and its cached copy."""
+    with _session_cache_lock:
+        _session_cache.pop(session_id, None)
+    try:
+        session_collection.delete_one({"_id": session_id})
+    except Exception as e:
+        logger.error("Error deleting session document for session_id %s: %s", session_id, e, exc_info=True)
+
 
-class MongoSessionMiddleware(BaseHTTPMiddleware):
+def touch_session_doc(session_id: str):
+    """Push the session expiry forward without waiting for the server to acknowledge."""
+    expires_at = utc_now() + timedelta(days=SESSION_LIFETIME_DAYS)
+    try:
+        session_collection_fast.update_one(
+            {"_id": session_id},
+            {"$set": {"expiresAt": expires_at}}
+        )
+        logger.debug("Session expiry refreshed for session_id: %s", session_id)
+    except Exception as e:
+        logger.error("Error refreshing session expiry for session_id %s: %s", session_id, e, exc_info=True)
+        return
+
+    _cache_session(session_id, None, expires_at)
+
+
+def session_flusher_running() -> bool:
+    return _flusher_task is not None and not _flusher_task.done()
+
+
+def queue_session_save(session_id: str, data: Optional[dict], refresh_expiry: bool = True):
     """
-    Custom middleware that:
+    Queue a session write for the background flusher; data=None only refreshes the expiry.
+    The cache is updated right away, so this worker sees the change before it is flushed.
+    Falls back to writing directly when the flusher is not running.
+    """
+    if not session_flusher_running():
+        if data is None:
+            touch_session_doc(session_id)
+        else:
+            save_session_doc(session_id, data, refresh_expiry)
+        return
+
+    expires_at = utc_now() + timedelta(days=SESSION_LIFETIME_DAYS) if refresh_expiry else None
+    # Encoding here also snapshots the data, so later mutations don't leak into the queued write.
+    blob = None if data is None else encode_session_data(data)
+    _cache_session(session_id, blob, expires_at)
+    _save_queue.put_nowait((session_id, blob, expires_at))
+
+
+async def queue_session_save_async(session_id: str, data: Optional[dict], refresh_expiry: bool = True):
+    """
+    queue_session_save for the event loop: when the flusher is not running the
+    save is a blocking Mongo write, so it runs in the threadpool.
+    """
+    if session_flusher_running():
+        queue_session_save(session_id, data, refresh_expiry)
+    else:
+        await run_in_threadpool(queue_session_save, session_id, data, refresh_expiry)
+
+
+def write_session_batch(items: list):
+    """
+    Write a batch of (session_id, data_z, expires_at) items with one bulk_write per write concern.
+    Items without data_z are expiry refreshes; items without expires_at leave the expiry alone.
+    """
+    saves = [
+        UpdateOne({"_id": session_id}, _session_update(blob, expires_at), upsert=True)
+        for session_id, blob, expires_at in items if blob is not None
+    ]
+    touches = [
+        UpdateOne({"_id": session_id}, {"$set": {"expiresAt": expires_at}})
+        for session_id, blob, expires_at in items if blob is None
+    ]
+    if saves:
+        try:
+            session_collection.bulk_write(saves, ordered=False)
+            logger.debug("Flushed %d session document(s)", len(saves))
+        except Exception as e:
+            logger.error("Error flushing session documents: %s", e, exc_info=True)
+            with _session_cache_lock:
+                for session_id, blob, _ in items:
+                    if blob is not None:
+                        _session_cache.pop(session_id, None)
+    if touches:
+        try:
+            session_collection_fast.bulk_write(touches, ordered=False)
+            logger.debug("Refreshed expiry of %d session document(s)", len(touches))
+        except Exception as e:
+            logger.error("Error refreshing session expiries: %s", e, exc_info=True)
+
+
+async def _session_flusher():
+    """Drain the save queue, de-duplicating by session_id within a batch, until a None sentinel arrives."""
+    loop = asyncio.get_running_loop()
+    running = True
+    while running:
+        item = await _save_queue.get()
+        batch = {}
+        deadline = loop.time() + SESSION_FLUSH_INTERVAL_SECONDS
+        while True:
+            if item is None:
+                running = False
+                break
+            session_id, blob, expires_at = item
+            if session_id in batch:
+                # Newest data and expiry win, but neither may drop one queued earlier in the batch.
+                _, queued_blob, queued_expires_at = batch[session_id]
+                blob = queued_blob if blob is None else blob
+                expires_at = queued_expires_at if expires_at is None else expires_at
+            batch[session_id] = (session_id, blob, expires_at)
+            timeout = deadline - loop.time()
+            if len(batch) >= SESSION_FLUSH_MAX_ITEMS or timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_save_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        if batch:
+            await run_in_threadpool(write_session_batch, list(batch.values()))
+
+
+def start_session_flusher():
+    """Start the background session writer; call from the app startup event."""
+    global _save_queue, _flusher_task
+    _save_queue = asyncio.Queue()
+    _flusher_task = asyncio.create_task(_session_flusher())
+
+
+async def stop_session_flusher():
+    """Flush pending session writes and stop the background writer; call on app shutdown."""
+    if _flusher_task is None or _flusher_task.done():
+        return
+    _save_queue.put_nowait(None)
+    await _flusher_task
+
+
+class MongoSessionMiddleware:
+    """
+    Custom pure ASGI middleware that:
       1. Reads session_id from the cookie.
-      2. Loads or creates a session document in Mongo.
-      3. Places the session data into request.state.session (a dict).
-      4. After the response, saves session data back to Mongo.
+      2. Places a LazySession into request.state.session; the session document
+         is only loaded from Mongo if the request reads or writes the session.
+      3. When the response starts, saves modified session data to Mongo under a new
+         session_id and adds the session_id cookie to the response headers if needed.
     """
 
     def __init__(self, app: ASGIApp):
-        super().__init__(app)
+        self.app = app
 
-    async def dispatch(self, request: Request, call_next):
-        # 1. Read session_id from cookie.
-        session_id = request.cookies.get(SESSION_COOKIE_NAME)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"].startswith(SESSION_SKIP_PREFIXES):
+            await self.app(scope, receive, send)
+            return
 
-        # 2. If missing or invalid, create a new session document.
-        if not session_id:
-            session_id = str(uuid.uuid4())
-            try:
-                create_session_doc(session_id)
-                session_data = {}
-            except Exception as e:
-                logger.error("Failed to create session: %s", e, exc_info=True)
-                raise HTTPException(status_code=500, detail="Session creation failed")
-        else:
-            # Load session from the database.
-            doc = get_session_doc(session_id)
-            if doc is None:
-                session_id = str(uuid.uuid4())
-                try:
-                    create_session_doc(session_id)
-                    session_data = {}
-                except Exception as e:
-                    logger.error("Failed to create new session after invalid session found: %s", e, exc_info=True)
-                    raise HTTPException(status_code=500, detail="Session creation failed")
-            else:
-                session_data = doc.get("data", {})
+        # 1. Read session_id from the Cookie header.
+        #    Only the one cookie is needed, so scan the raw bytes instead of parsing them all.
+        cookie_session_id = None
+        for key, value in scope["headers"]:
+            if key == b"cookie":
+                for part in value.split(b";"):
+                    part = part.strip()
+                    if part.startswith(_COOKIE_PREFIX):
+                        cookie_session_id = part[len(_COOKIE_PREFIX):].decode("latin-1") or None
+                        break
+                break
 
-        # 3. Attach the session data and session_id to request.state.
-        request.state.session = session_data
-        request.state._session_id = session_id
+        # 2. Attach the (not yet loaded) session to request.state. A missing or invalid
+        #    cookie starts a new, empty session; its document is upserted on the first
+        #    save that carries data.
+        session = LazySession(cookie_session_id)
+        scope.setdefault("state", {})["session"] = session
 
-        # 4. Process the request.
-        response = await call_next(request)
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start" and session.loaded:
+                # 4. Save changed session data before the headers go out, acknowledged, under
+                #    a fresh session id (the old document is deleted). Other workers may hold
+                #    the old id's document in their cache for up to SESSION_CACHE_TTL_SECONDS;
+                #    a new id has no cached copy anywhere, so the follow-up request (e.g. after
+                #    a redirect, on any worker) reads the new data from Mongo. It also keeps an
+                #    older copy from being written back over it. Changes are rare (login, site
+                #    selection, logout). Expiry refreshes only touch expiresAt, so they go
+                #    through the batched, unacknowledged path; the expiry is only refreshed
+                #    once it falls within SESSION_REFRESH_THRESHOLD.
+                session_id = session.session_id
+                persisted = session.expires_at is not None
+                if session._dirty:
+                    new_id = new_session_id() if persisted else session_id
+                    try:
+                        await run_in_threadpool(save_session_doc, new_id, session.load())
+                    except Exception as e:
+                        logger.error("Failed to save session document for session_id %s: %s", new_id, e, exc_info=True)
+                    else:
+                        if new_id != session_id:
+                            await run_in_threadpool(delete_session_doc, session_id)
+                        session.session_id = session_id = new_id
+                        persisted = True
+                elif persisted and session_expiry_due(session.expires_at):
+                    await queue_session_save_async(session_id, None)
 
-        # 5. Save the updated session back to Mongo.
-        updated_data = request.state.session
-        try:
-            save_session_doc(session_id, updated_data)
-        except Exception as e:
-            logger.error("Failed to save session document for session_id %s: %s", session_id, e, exc_info=True)
-            # Optionally, you could modify the response to indicate session save failure.
-
-        # 6. Ensure the session_id cookie is set.
-        if request.cookies.get(SESSION_COOKIE_NAME) != session_id:
-            response.set_cookie(
-                key=SESSION_COOKIE_NAME,
-                value=session_id,
-                max_age=SESSION_LIFETIME_DAYS * 24 * 60 * 60,
-                httponly=True,
-                samesite="lax",
-                secure=False  # Set to True if using HTTPS.
-            )
-
-        return response
+                # 5. Ensure the session_id cookie is set once the session exists in Mongo.
+                if persisted and cookie_session_id != session_id:
+                    headers = MutableHeaders(scope=message)
+                    headers.raw.append((b"set-cookie", _COOKIE_PREFIX + session_id.encode("latin-1") + _COOKIE_SUFFIX))
+            await send(message)
+
+        # 3. Process the request.
+        await self.app(scope, receive, send_wrapper)
@@ -1,31 +1,60 @@
+import json
 import logging
-import requests
-from datetime import datetime
+import time
+import httpx
+from functools import lru_cache
 import google_auth_oauthlib.flow
-import google.oauth2.credentials
 
+from pymongo import ReturnDocument
 from fastapi import APIRouter, Request
 from fastapi.responses import RedirectResponse
+from starlette.concurrency import run_in_threadpool
 from routes.flash import flash, get_flashed_messages
 
-from db_client import client  # your Mongo client
-from .utils import credentials_to_dict  # helper to convert credentials to dict
+from db_client import client, utc_now  # your Mongo client
+from .utils import credentials_to_dict, credentials_from_dict  # helpers to convert credentials to/from dict
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+db = client["apimio"]
+users_coll = db["users"]
+
 # Use your production OAuth credentials file.
 CLIENT_SECRETS_FILE = "client_secret.json"
-SCOPES = [
+SCOPES = (
     'https://www.googleapis.com/auth/webmasters.readonly',
     'openid',
     'https://www.googleapis.com/auth/userinfo.email',
     'https://www.googleapis.com/auth/userinfo.profile'
-]
+)
+
+# Seconds before the stored expiry at which credentials are treated as expired.
+CREDENTIALS_EXPIRY_SKEW_SECONDS = 30
+
+USERINFO_ENDPOINT = "https://www.googleapis.com/oauth2/v1/userinfo"
+
+# Shared async HTTP client so Google calls reuse pooled connections; closed on app shutdown.
+http_client = httpx.AsyncClient(timeout=10.0)
+
+async def close_http_client():
+    """Closes the shared async HTTP client."""
+    await http_client.aclose()
+
+@lru_cache(maxsize=1)
+def load_client_config() -> dict:
+    """
+    Reads the OAuth client secrets file once and keeps the parsed config,
+    so the OAuth routes do not hit the filesystem on every request.
+    """
+    with open(CLIENT_SECRETS_FILE) as f:
+        return json.load(f)
 
 def validate_credentials(request: Request) -> bool:
     """
-    Reconstructs the credentials from session and checks if they have expired.
+    Checks whether the credentials in the session have expired.
+    Uses the stored expiry timestamp when present, and only rebuilds the
+    Credentials object for sessions written before expiry_ts existed.
     Returns True if valid; False otherwise.
     """
     creds_dict = request.state.session.get("credentials")
@@ -33,14 +62,14 @@ def validate_credentials(request: Request) -> bool:
         logger.info("No credentials found in session.")
         return False
     try:
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict.get("refresh_token"),
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
-        )
+        if "expiry_ts" in creds_dict:
+            expiry_ts = creds_dict["expiry_ts"]
+            # Treat tokens as expired slightly early to allow for clock skew.
+            if expiry_ts is not None and expiry_ts <= time.time() + CREDENTIALS_EXPIRY_SKEW_SECONDS:
+                logger.info("Credentials have expired.")
+                return False
+            return True
+        creds = credentials_from_dict(creds_dict)
         # google.oauth2.credentials.Credentials computes .expired based on its expiry.
         if creds.expired:
             logger.info("Credentials have expired.")
@@ -58,8 +87,8 @@ def authorize(request: Request):
     """
     logger.info("Starting OAuth flow for public authentication")
     try:
-        flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-            CLIENT_SECRETS_FILE, scopes=SCOPES
+        flow = google_auth_oauthlib.flow.Flow.from_client_config(
+            load_client_config(), scopes=SCOPES
         )
         # Dynamically generate the callback URL for OAuth2.
         callback_url = request.url_for("auth_oauth2callback")
@@ -82,36 +111,39 @@ def authorize(request: Request):
         return f"Error during authorization: {e}"
 
 @router.get("/oauth2callback", name="auth_oauth2callback")
-def oauth2callback(request: Request):
+async def oauth2callback(request: Request):
     """
     Handles the Google OAuth callback.
     Exchanges the authorization code for tokens, retrieves user info, and upserts the user in the database.
     This modified flow now accepts any Google user.
+    Blocking calls (token exchange, Mongo) run in the threadpool so the event loop stays free.
     """
     logger.info("Received OAuth2 callback")
+    # The session loads on first access with a blocking Mongo read; load it in the
+    # threadpool first so the accesses below don't block the event loop.
+    await run_in_threadpool(request.state.session.load)
     state = request.state.session.get('state')
     if not state:
         logger.error("Missing state in session during callback")
         flash(request, "Session expired or invalid. Please try again.", "danger")
         return "Session state missing. Please try again."
     try:
-        flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-            CLIENT_SECRETS_FILE, scopes=SCOPES, state=state
+        flow = google_auth_oauthlib.flow.Flow.from_client_config(
+            load_client_config(), scopes=SCOPES, state=state
         )
         flow.redirect_uri = str(request.url_for("auth_oauth2callback"))
 
         # Exchange the authorization code for tokens.
         authorization_response = str(request.url)
-        flow.fetch_token(authorization_response=authorization_response)
+        await run_in_threadpool(flow.fetch_token, authorization_response=authorization_response)
 
         credentials = flow.credentials
         request.state.session['credentials'] = credentials_to_dict(credentials)
         logger.info("Successfully obtained and stored OAuth tokens")
 
         # Fetch user information from Google's UserInfo endpoint.
-        userinfo_endpoint = "https://www.googleapis.com/oauth2/v1/userinfo"
         headers = {"Authorization": f"Bearer {credentials.token}"}
-        response = requests.get(userinfo_endpoint, headers=headers)
+        response = await http_client.get(USERINFO_ENDPOINT, headers=headers)
         if response.status_code == 200:
             user_info = response.json()
             logger.info("Fetched user profile: %s", user_info)
@@ -121,11 +153,11 @@ def oauth2callback(request: Request):
             request.state.session["user_name"] = user_info.get("name")
 
             # Upsert the user in the database.
-            db = client["apimio"]
-            users_coll = db["users"]
             user_email = user_info["email"]
-            now = datetime.utcnow()
-            users_coll.update_one(
+            now = utc_now()
+            # Upsert and read back the _id in a single round-trip.
+            found_user = await run_in_threadpool(
+                users_coll.find_one_and_update,
                 {"email": user_email},
                 {
                     "$set": {
@@ -136,14 +168,17 @@ def oauth2callback(request: Request):
                         "createdAt": now
                     }
                 },
-                upsert=True
+                projection={"_id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
             )
             logger.info("User record upserted for email: %s", user_email)
 
-            # Retrieve the user document to store the user ID in session.
-            found_user = users_coll.find_one({"email": user_email})
             if found_user:
                 request.state.session["user_id"] = str(found_user["_id"])
+                # Sessions are stored as BSON, so the ObjectId itself round-trips; handlers
+                # read it through require_user instead of re-parsing the hex string.
+                request.state.session["user_oid"] = found_user["_id"]
                 logger.info("Stored user_id in session: %s", request.state.session["user_id"])
                 flash(request, "Login successful! Welcome back.", "success")
             else:
@@ -1,43 +1,132 @@
 # routes/clusters.py
 
+import os
+import re
 import logging
+import threading
+from functools import lru_cache
+from itertools import chain
 from datetime import datetime, timedelta, date
 from bson.objectid import ObjectId
-from urllib.parse import urlparse
+from cachetools import TTLCache
+from urllib.parse import urlparse, ParseResult
+from concurrent.futures import ThreadPoolExecutor
 
 import pymongo
-import google.oauth2.credentials
-from googleapiclient.discovery import build
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError, ClientBulkWriteException, DuplicateKeyError
 
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Callable, List, Optional
 
-from fastapi import APIRouter, Request, Form, Query, status, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, Request, Form, Query, status, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from starlette.templating import Jinja2Templates
 from routes.flash import flash, get_flashed_messages
+from routes.utils import after_object_id, build_gsc_service, cluster_object_id, credentials_from_dict, link_object_id, require_selected_site, require_user, templates
 
 
 
-from db_client import client
+from db_client import SUPPORTS_CLIENT_BULK_WRITE, client, run_in_transaction, utc_now
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
+
+# Database handle shared by every route; MongoClient is thread-safe and pools its own connections.
+db = client["apimio"]
+clusters_coll = db["clusters"]
+links_coll = db["links"]
+perf_coll = db["link_performance"]
+
+# Page size for the cluster and link listings (overridable with ?per_page=, up to the max).
+LIST_PAGE_SIZE = 100
+LIST_PAGE_SIZE_MAX = 500
+# Cluster fields read by the GSC fetch job (fetch_3months_gsc_data_for_links).
+CLUSTER_GSC_PROJECTION = {"domain": 1, "deviceFilter": 1, "countryFilter": 1}
+# link_performance fields shown on the performance pages.
+PERF_ROW_PROJECTION = {"_id": 0, "date": 1, "clicks": 1, "impressions": 1, "ctr": 1, "position": 1}
+# Cluster and link fields read by the trash page (deleted picks the trashed clusters).
+TRASH_CLUSTER_PROJECTION = {"clusterName": 1, "domain": 1, "deleted": 1, "deletedAt": 1}
+TRASH_LINK_PROJECTION = {"url": 1, "deletedAt": 1}
+# Rows fetched per round trip when streaming performance rows into a template.
+PERF_CURSOR_BATCH_SIZE = 500
+# Row partials are refetched on every load: the shell reloads them right after a
+# create, trash or edit redirect, so a cached fragment would show the old rows.
+PARTIAL_CACHE_HEADERS = {"Cache-Control": "private, no-cache"}
+
+# In-process cache of cluster docs for the link and performance handlers, which only
+# read the cluster's settings. This process drops an entry when it changes the cluster;
+# with several workers, a cached doc can be stale for up to the TTL.
+CLUSTER_CACHE_TTL_SECONDS = 30
+_cluster_cache = TTLCache(maxsize=4096, ttl=CLUSTER_CACHE_TTL_SECONDS)
+_cluster_cache_lock = threading.Lock()
+
+
+def get_cluster(cluster_oid: ObjectId) -> Optional[dict]:
+    """
+    Returns the cluster doc (trashed or not) with this _id, or None, from the cache
+    when possible. The doc is shared between requests and must not be modified.
+    """
+    with _cluster_cache_lock:
+        cluster = _cluster_cache.get(cluster_oid)
+    if cluster is None:
+        cluster = clusters_coll.find_one({"_id": cluster_oid})
+        if cluster is not None:
+            with _cluster_cache_lock:
+                _cluster_cache[cluster_oid] = cluster
+    return cluster
+
+
+def invalidate_cluster(cluster_oid: ObjectId):
+    """Drops the cached doc of a cluster this process has just changed."""
+    with _cluster_cache_lock:
+        _cluster_cache.pop(cluster_oid, None)
+
+
+def write_in_order(*writes):
+    """
+    Applies (collection, op) writes in order, stopping at the first failure; each op
+    carries namespace=collection.full_name. On MongoDB 8.0+ they go out as one ordered
+    bulkWrite command, otherwise as one write per op. A duplicate-key error on any op
+    is raised as DuplicateKeyError either way.
+    """
+    try:
+        if SUPPORTS_CLIENT_BULK_WRITE:
+            client.bulk_write([op for _, op in writes], ordered=True)
+        else:
+            for collection, op in writes:
+                collection.bulk_write([op])
+    except (BulkWriteError, ClientBulkWriteException) as e:
+        write_errors = e.details.get("writeErrors", []) if isinstance(e, BulkWriteError) else e.write_errors or []
+        for err in write_errors:
+            if err.get("code") == 11000:
+                raise DuplicateKeyError(err.get("errmsg", "E11000 duplicate key error"), 11000, err) from e
+        raise
 
 
 def check_domain_consistency(cluster_domain: str, link_url: str) -> bool:
     """
     Ensures link_url belongs to cluster_domain.
-    For 'sc-domain:apimio.com', it checks if the netloc ends with 'apimio.com'.
-    For a URL prefix like 'https://apimio.com/', it compares the scheme and netloc.
+    Results are memoized per (cluster_domain, link_url) pair, since bulk link adds
+    re-validate the same domain and often the same URLs across requests.
+    """
+    return _check_domain_consistency(cluster_domain, link_url)
+
+
+@lru_cache(maxsize=4096)
+def _check_domain_consistency(cluster_domain: str, link_url: str) -> bool:
+    """
+    Uncached implementation of check_domain_consistency.
     Returns False if any errors occur or if the URLs are improperly formatted.
     """
     if not cluster_domain or not link_url:
         logger.error("Missing cluster_domain or link_url: cluster_domain=%s, link_url=%s", cluster_domain, link_url)
         return False
 
+    matches_domain = domain_matcher(cluster_domain)
+    if matches_domain is None:
+        return False
+
     try:
         parsed_link = urlparse(link_url)
     except Exception as e:
@@ -48,28 +137,39 @@ def check_domain_consistency(cluster_domain: str, link_url: str) -> bool:
         logger.error("Invalid link_url format: %s", link_url)
         return False
 
+    return matches_domain(parsed_link)
+
+
+@lru_cache(maxsize=256)
+def domain_matcher(cluster_domain: str) -> Optional[Callable[[ParseResult], bool]]:
+    """
+    Parses cluster_domain once and returns a predicate over a parsed link URL,
+    so validating a batch of links only parses each link.
+    For 'sc-domain:apimio.com', it checks if the netloc ends with 'apimio.com'.
+    For a URL prefix like 'https://apimio.com/', it compares the scheme and netloc.
+    Returns None if cluster_domain is improperly formatted.
+    """
     if cluster_domain.startswith("sc-domain:"):
         # Handle domain shorthand, e.g. "sc-domain:apimio.com"
-        domain_part = cluster_domain.replace("sc-domain:", "", 1)
+        domain_part = cluster_domain[len("sc-domain:"):]
         if not domain_part:
             logger.error("Empty domain part in cluster_domain: %s", cluster_domain)
-            return False
-        return parsed_link.netloc.endswith(domain_part)
-    else:
-        # Assume cluster_domain is a full URL prefix.
-        try:
-            parsed_cluster = urlparse(cluster_domain)
-        except Exception as e:
-            logger.error("Error parsing cluster_domain '%s': %s", cluster_domain, e, exc_info=True)
-            return False
+            return None
+        return lambda parsed_link: parsed_link.netloc.endswith(domain_part)
 
-        if not parsed_cluster.scheme or not parsed_cluster.netloc:
-            logger.error("Invalid cluster_domain format: %s", cluster_domain)
-            return False
+    # Assume cluster_domain is a full URL prefix.
+    try:
+        parsed_cluster = urlparse(cluster_domain)
+    except Exception as e:
+        logger.error("Error parsing cluster_domain '%s': %s", cluster_domain, e, exc_info=True)
+        return None
 
-        same_scheme = (parsed_link.scheme == parsed_cluster.scheme)
-        same_host = (parsed_link.netloc == parsed_cluster.netloc)
-        return same_scheme and same_host
+    if not parsed_cluster.scheme or not parsed_cluster.netloc:
+        logger.error("Invalid cluster_domain format: %s", cluster_domain)
+        return None
+
+    scheme, netloc = parsed_cluster.scheme, parsed_cluster.netloc
+    return lambda parsed_link: parsed_link.scheme == scheme and parsed_link.netloc == netloc
 
 
 
@@ -87,35 +187,19 @@ class ClustersPayload(BaseModel):
 
 
 @router.get("/clusters", response_class=HTMLResponse, name="clusters_list_clusters")
-def list_clusters(request: Request):
+def list_clusters(
+    request: Request,
+    per_page: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_SIZE_MAX),
+    domain: str = Depends(require_selected_site)
+):
     """
-    Lists all active clusters (deleted=False) for the selected domain.
+    Renders the cluster list page for the selected domain without its rows;
+    the page loads them from clusters_list_rows with HTMX, one page at a time.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not initialized in request.state")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session or "selected_site" not in request.state.session:
-        flash(request, "Session expired or invalid. Please log in again.", "warning") 
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-    
-    try:
-        user_id = request.state.session["user_id"]
-        domain = request.state.session["selected_site"]
-        db = client["apimio"]
-        cluster_docs = list(db.clusters.find({
-            "userId": ObjectId(user_id),
-            "domain": domain,
-            "deleted": False
-        }))
-    except Exception as e:
-        logger.error("Error retrieving clusters: %s", e, exc_info=True)
-        flash(request, "Unable to retrieve clusters. Please try again later.", "danger")
-        raise HTTPException(status_code=500, detail="Error retrieving clusters.")
-    
     try:
         return templates.TemplateResponse("Dashboard/CLusters/list.html", {
             "request": request,
-            "clusters": cluster_docs,
+            "per_page": per_page,
             "domain": domain,
             "flash_messages": get_flashed_messages(request)
         })
@@ -125,21 +209,48 @@ def list_clusters(request: Request):
         raise HTTPException(status_code=500, detail="Error rendering page.")
 
 
+@router.get("/clusters/_rows", response_class=HTMLResponse, name="clusters_list_rows")
+def list_cluster_rows(
+    request: Request,
+    after: Optional[ObjectId] = Depends(after_object_id),
+    per_page: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_SIZE_MAX),
+    user_id: ObjectId = Depends(require_user),
+    domain: str = Depends(require_selected_site)
+):
+    """
+    HTMX partial: the next page of active clusters (deleted=False) after the cluster id `after`.
+    The cursor is handed to the template unmaterialized; it fetches one extra
+    document so the template can tell whether to render a "load more" row.
+    """
+    query = {"userId": user_id, "domain": domain, "deleted": False}
+    try:
+        if after:
+            query["_id"] = {"$gt": after}
+        cluster_docs = clusters_coll.find(
+            query,
+            {"clusterName": 1, "deviceFilter": 1, "countryFilter": 1}
+        ).sort("_id", 1).limit(per_page + 1)
+    except Exception as e:
+        logger.error("Error retrieving clusters: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail="Error retrieving clusters.")
+
+    try:
+        return templates.TemplateResponse("Dashboard/CLusters/_rows.html", {
+            "request": request,
+            "clusters": cluster_docs,
+            "per_page": per_page
+        }, headers=PARTIAL_CACHE_HEADERS)
+    except Exception as e:
+        logger.error("Error rendering cluster rows: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail="Error rendering cluster rows.")
+
+
 @router.get("/clusters/new", response_class=HTMLResponse, name="clusters_new_form")
-def new_cluster_form(request: Request):
+def new_cluster_form(request: Request, domain: str = Depends(require_selected_site)):
     """
     Renders a form to add new clusters.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available")
-        flash(request, "Session not available. Please try again later.", "danger")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session or "selected_site" not in request.state.session:
-        flash(request, "Your session has expired. Please log in again.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-    
     try:
-        domain = request.state.session["selected_site"]
         return templates.TemplateResponse("Dashboard/CLusters/new.html", {
             "request": request,
             "domain": domain,
@@ -155,7 +266,9 @@ def new_cluster_form(request: Request):
 @router.post("/clusters/new-json", name="clusters_new_json")
 def new_cluster_json_action(
     request: Request,
-    payload: ClustersPayload  # <--- Pydantic model for JSON body
+    payload: ClustersPayload,  # <--- Pydantic model for JSON body
+    user_id: ObjectId = Depends(require_user),
+    domain: str = Depends(require_selected_site)
 ):
     """
     POST /clusters/new-json
@@ -173,121 +286,124 @@ def new_cluster_json_action(
       ]
     }
     """
-    # 1. Validate session presence
-    if "user_id" not in request.state.session or "selected_site" not in request.state.session:
-        # If not authenticated or no domain selected, redirect or return error
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-
-    user_id = request.state.session["user_id"]
-    domain = request.state.session["selected_site"]
+    now = utc_now()
+    created_count = 0
 
-    # 2. Setup database reference
+    # 1. Fetch all clusters that clash with the payload names in one query
+    names = [c.clusterName.strip() for c in payload.clusters if c.clusterName.strip()]
     try:
-        db = client["apimio"]  # your MongoDB reference
+        existing_map = {
+            doc["clusterName"]: doc
+            for doc in clusters_coll.find(
+                {
+                    "userId": user_id,
+                    "domain": domain,
+                    "clusterName": {"$in": names}
+                },
+                {"clusterName": 1, "deleted": 1}
+            )
+        }
     except Exception as e:
-        # Log the error as needed
+        logger.error("Error checking existing clusters: %s", e, exc_info=True)
         return JSONResponse(
             status_code=500,
-            content={"detail": "Database connection failed."}
+            content={"detail": "Error checking existing clusters."}
         )
 
-    now = datetime.utcnow()
-    created_count = 0
-
-    # 3. Process clusters from payload
+    # 2. Validate the payload against existing clusters (and itself) in memory
+    to_insert = []
+    seen_names = set()
     for cluster_data in payload.clusters:
         name_stripped = cluster_data.clusterName.strip()
         if not name_stripped:
             # Skip if clusterName is empty after stripping
             continue
 
-        # Use default values if not provided
-        device_filter = cluster_data.deviceFilter or "ALL"
-        country_filter = cluster_data.countryFilter or "ALL"
-
-        try:
-            # 4. Check for duplicate clusters
-            existing = db.clusters.find_one({
-                "userId": ObjectId(user_id),
-                "domain": domain,
-                "clusterName": name_stripped
-            })
-        except Exception as e:
-            # Log the error as needed
+        existing = existing_map.get(name_stripped)
+        if existing and existing.get("deleted"):
             return JSONResponse(
-                status_code=500,
-                content={"detail": "Error checking existing clusters."}
+                status_code=400,
+                content={
+                    "detail": f"Cluster '{name_stripped}' is in trash. "
+                              "Please restore or choose a different name."
+                }
             )
+        if existing or name_stripped in seen_names:
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "detail": f"Cluster '{name_stripped}' already exists for domain '{domain}'."
+                }
+            )
+        seen_names.add(name_stripped)
 
-        if existing:
-            if existing.get("deleted"):
-                return JSONResponse(
-                    status_code=400,
-                    content={
-                        "detail": f"Cluster '{name_stripped}' is in trash. "
-                                  "Please restore or choose a different name."
-                    }
-                )
-            else:
+        to_insert.append({
+            "userId": user_id,
+            "domain": domain,
+            "clusterName": name_stripped,
+            # Use default values if not provided
+            "deviceFilter": cluster_data.deviceFilter or "ALL",
+            "countryFilter": cluster_data.countryFilter or "ALL",
+            "deleted": False,
+            "deletedAt": None,
+            "createdAt": now,
+            "updatedAt": now
+        })
+
+    # 3. Insert the new cluster documents in one batch. The unique index on
+    #    (userId, domain, clusterName) catches names created concurrently since step 2.
+    if to_insert:
+        try:
+            result = clusters_coll.insert_many(to_insert, ordered=False)
+            created_count = len(result.inserted_ids)
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            if write_errors and all(err.get("code") == 11000 for err in write_errors):
                 return JSONResponse(
                     status_code=400,
                     content={
-                        "detail": f"Cluster '{name_stripped}' already exists for domain '{domain}'."
+                        "detail": f"Created {e.details.get('nInserted', 0)} cluster(s); "
+                                  f"{len(write_errors)} already exist for domain '{domain}'."
                     }
                 )
-
-        try:
-            # 5. Insert the new cluster document
-            db.clusters.insert_one({
-                "userId": ObjectId(user_id),
-                "domain": domain,
-                "clusterName": name_stripped,
-                "deviceFilter": device_filter,
-                "countryFilter": country_filter,
-                "deleted": False,
-                "deletedAt": None,
-                "createdAt": now,
-                "updatedAt": now
-            })
-            created_count += 1
+            logger.error("Error inserting clusters: %s", e, exc_info=True)
+            return JSONResponse(
+                status_code=500,
+                content={"detail": "Error inserting clusters."}
+            )
         except Exception as e:
-            # Log the error as needed, continue processing other clusters if desired
-            # Alternatively, you might choose to abort and rollback if partial success is not allowed.
+            logger.error("Error inserting clusters: %s", e, exc_info=True)
             return JSONResponse(
                 status_code=500,
-                content={"detail": f"Error inserting cluster '{name_stripped}'."}
+                content={"detail": "Error inserting clusters."}
             )
 
-    # 6. Handle case where no valid clusters were inserted
+    # 4. Handle case where no valid clusters were inserted
     if created_count == 0:
         return JSONResponse(
             status_code=400,
             content={"detail": "All cluster names were empty or invalid."}
         )
 
-    # 7. Return success response
+    # 5. Return success response
     return JSONResponse(
         status_code=status.HTTP_201_CREATED,
         content={"detail": f"Created {created_count} cluster(s)."}
     )
 
 
-@router.get("/clusters/{cluster_id}", response_class=HTMLResponse, name="clusters_show_cluster")
-def show_cluster(request: Request, cluster_id: str):
+@router.get("/clusters/{cluster_id}", response_class=HTMLResponse, name="clusters_show_cluster", dependencies=[Depends(require_user)])
+def show_cluster(
+    request: Request,
+    cluster_id: ObjectId = Depends(cluster_object_id),
+    per_page: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_SIZE_MAX)
+):
     """
-    Shows details of a single cluster (if not deleted) and its associated non-deleted links.
+    Shows details of a single cluster (if not deleted); the page loads its
+    non-deleted links from clusters_link_rows with HTMX, one page at a time.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available")
-        flash(request, "Session not available. Please try again later.", "danger")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session:
-        flash(request, "Your session has expired. Please log in again.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-    
     try:
-        db = client["apimio"]
-        cluster = db.clusters.find_one({"_id": ObjectId(cluster_id), "deleted": False})
+        cluster = clusters_coll.find_one({"_id": cluster_id, "deleted": False}, {"clusterName": 1, "domain": 1})
         if not cluster:
             flash(request, "The requested cluster was not found or has been deleted.", "danger")
             raise HTTPException(status_code=404, detail="Cluster not found or deleted.")
@@ -296,22 +412,11 @@ def show_cluster(request: Request, cluster_id: str):
         flash(request, "There was an error retrieving cluster details. Please try again.", "danger")
         raise HTTPException(status_code=500, detail="Error retrieving cluster.")
 
-    try:
-        # Fetch non-deleted links for the cluster
-        link_docs = list(db.links.find({
-            "clusterId": cluster["_id"],
-            "deleted": False
-        }))
-    except Exception as e:
-        logger.error("Error retrieving links: %s", e, exc_info=True)
-        flash(request, "There was an error retrieving associated links. Please try again.", "danger")
-        raise HTTPException(status_code=500, detail="Error retrieving cluster links.")
-
     try:
         return templates.TemplateResponse("Dashboard/CLusters/detail.html", {
             "request": request,
             "cluster": cluster,
-            "links": link_docs,
+            "per_page": per_page,
             "flash_messages": get_flashed_messages(request)
         })
     except Exception as e:
@@ -320,22 +425,48 @@ def show_cluster(request: Request, cluster_id: str):
         raise HTTPException(status_code=500, detail="Error rendering cluster detail page.")
 
 
-@router.get("/clusters/{cluster_id}/edit", response_class=HTMLResponse, name="clusters_edit_cluster_form")
-def edit_cluster_form(request: Request, cluster_id: str):
+@router.get("/clusters/{cluster_id}/_links", response_class=HTMLResponse, name="clusters_link_rows", dependencies=[Depends(require_user)])
+def cluster_link_rows(
+    request: Request,
+    cluster_id: ObjectId = Depends(cluster_object_id),
+    after: Optional[ObjectId] = Depends(after_object_id),
+    per_page: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_SIZE_MAX)
+):
+    """
+    HTMX partial: the next page of a cluster's non-deleted links after the link id `after`.
+    """
+    try:
+        query = {"clusterId": cluster_id, "deleted": False}
+        if after:
+            query["_id"] = {"$gt": after}
+        # Streamed into the template, plus one to detect whether there is more
+        link_docs = links_coll.find(
+            query,
+            {"url": 1, "status": 1, "clusterId": 1}
+        ).sort("_id", 1).limit(per_page + 1)
+    except Exception as e:
+        logger.error("Error retrieving links: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail="Error retrieving cluster links.")
+
+    try:
+        return templates.TemplateResponse("Dashboard/CLusters/_link_rows.html", {
+            "request": request,
+            "cluster_id": cluster_id,
+            "links": link_docs,
+            "per_page": per_page
+        }, headers=PARTIAL_CACHE_HEADERS)
+    except Exception as e:
+        logger.error("Error rendering link rows: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail="Error rendering link rows.")
+
+
+@router.get("/clusters/{cluster_id}/edit", response_class=HTMLResponse, name="clusters_edit_cluster_form", dependencies=[Depends(require_user)])
+def edit_cluster_form(request: Request, cluster_id: ObjectId = Depends(cluster_object_id)):
     """
     Renders the edit form for a cluster.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available")
-        flash(request, "Session not available. Please try again later.", "danger")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session:
-        flash(request, "Your session has expired. Please log in again.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-    
     try:
-        db = client["apimio"]
-        cluster = db.clusters.find_one({"_id": ObjectId(cluster_id)})
+        cluster = clusters_coll.find_one({"_id": cluster_id}, {"clusterName": 1, "deviceFilter": 1, "countryFilter": 1})
         if not cluster:
             flash(request, "The requested cluster was not found.", "danger")
             raise HTTPException(status_code=404, detail="Cluster not found")
@@ -350,10 +481,10 @@ def edit_cluster_form(request: Request, cluster_id: str):
         raise HTTPException(status_code=500, detail="Error rendering edit cluster form.")
 
 
-@router.post("/clusters/{cluster_id}/edit", name="clusters_edit_cluster_post")
+@router.post("/clusters/{cluster_id}/edit", name="clusters_edit_cluster_post", dependencies=[Depends(require_user)])
 def edit_cluster_action(
     request: Request,
-    cluster_id: str,
+    cluster_id: ObjectId = Depends(cluster_object_id),
     clusterName: str = Form(...),
     deviceFilter: str = Form("ALL"),
     countryFilter: str = Form("ALL")
@@ -361,17 +492,8 @@ def edit_cluster_action(
     """
     Updates a cluster's details ensuring no duplicate names exist.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available")
-        flash(request, "Session not available. Please try again later.", "danger")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session:
-        flash(request, "Your session has expired. Please log in again.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-    
     try:
-        db = client["apimio"]
-        cluster = db.clusters.find_one({"_id": ObjectId(cluster_id)})
+        cluster = clusters_coll.find_one({"_id": cluster_id}, {"_id": 1})
         if not cluster:
             flash(request, "The requested cluster was not found.", "danger")
             raise HTTPException(status_code=404, detail="Cluster not found")
@@ -389,24 +511,9 @@ def edit_cluster_action(
         raise HTTPException(status_code=400, detail="Cluster name cannot be empty.")
 
     try:
-        # Check for uniqueness of cluster name for the same user and domain.
-        existing = db.clusters.find_one({
-            "userId": cluster["userId"],
-            "domain": cluster["domain"],
-            "clusterName": new_name,
-            "_id": {"$ne": cluster["_id"]}
-        })
-        if existing:
-            flash(request, f"A cluster named '{new_name}' already exists for this domain.", "danger")
-            raise HTTPException(status_code=400, detail=f"A cluster named '{new_name}' already exists for this domain.")
-    except Exception as e:
-        logger.error("Error checking cluster uniqueness: %s", e, exc_info=True)
-        flash(request, "Error checking cluster uniqueness. Please try again.", "danger")
-        raise HTTPException(status_code=500, detail="Error checking cluster uniqueness.")
-
-    try:
-        now = datetime.utcnow()
-        db.clusters.update_one(
+        now = utc_now()
+        # Name uniqueness per user and domain is enforced by the unique index on clusters.
+        clusters_coll.update_one(
             {"_id": cluster["_id"]},
             {"$set": {
                 "clusterName": new_name,
@@ -415,7 +522,11 @@ def edit_cluster_action(
                 "updatedAt": now
             }}
         )
+        invalidate_cluster(cluster["_id"])
         flash(request, "Cluster updated successfully!", "success")
+    except DuplicateKeyError:
+        flash(request, f"A cluster named '{new_name}' already exists for this domain.", "danger")
+        raise HTTPException(status_code=400, detail=f"A cluster named '{new_name}' already exists for this domain.")
     except Exception as e:
         logger.error("Error updating cluster: %s", e, exc_info=True)
         flash(request, "There was an error updating the cluster. Please try again.", "danger")
@@ -429,25 +540,14 @@ def edit_cluster_action(
         raise HTTPException(status_code=500, detail="Error redirecting after editing cluster.")
 
 
-@router.post("/clusters/{cluster_id}/delete", name="clusters_delete_cluster")
-def delete_cluster(request: Request, cluster_id: str):
+@router.post("/clusters/{cluster_id}/delete", name="clusters_delete_cluster", dependencies=[Depends(require_user)])
+def delete_cluster(request: Request, cluster_id: ObjectId = Depends(cluster_object_id)):
     """
     Soft-deletes a cluster and all its associated links and performance data.
     On success or error, a flash message is set and the user is redirected.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available")
-        # Flash error and redirect
-        flash(request, "Session not available", "error")
-        return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
-    
-    if "user_id" not in request.state.session:
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-    
-    db = client["apimio"]
-    
     try:
-        cluster = db.clusters.find_one({"_id": ObjectId(cluster_id), "deleted": {"$ne": True}})
+        cluster = clusters_coll.find_one({"_id": cluster_id, "deleted": False}, {"_id": 1})
         if not cluster:
             flash(request, "Cluster not found or already trashed.", "error")
             return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
@@ -456,40 +556,33 @@ def delete_cluster(request: Request, cluster_id: str):
         flash(request, "Error retrieving cluster for deletion.", "error")
         return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
     
-    now = datetime.utcnow()
+    now = utc_now()
     
-    try:
-        # Soft-delete the cluster
-        db.clusters.update_one(
+    def soft_delete(session):
+        # Soft-delete the cluster, all links under it, and their performance data
+        clusters_coll.update_one(
             {"_id": cluster["_id"]},
-            {"$set": {"deleted": True, "deletedAt": now}}
+            {"$set": {"deleted": True, "deletedAt": now}},
+            session=session
         )
-    except Exception as e:
-        logger.error("Error marking cluster as trashed: %s", e, exc_info=True)
-        flash(request, "Error deleting cluster.", "error")
-        return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
-    
-    try:
-        # Soft-delete all links under this cluster
-        db.links.update_many(
-            {"clusterId": cluster["_id"], "deleted": {"$ne": True}},
-            {"$set": {"deleted": True, "deletedAt": now}}
+        links_coll.update_many(
+            {"clusterId": cluster["_id"], "deleted": False},
+            {"$set": {"deleted": True, "deletedAt": now}},
+            session=session
         )
-    except Exception as e:
-        logger.error("Error deleting cluster links: %s", e, exc_info=True)
-        flash(request, "Error deleting cluster links.", "error")
-        return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
-    
-    try:
-        # Soft-delete performance data for the links under this cluster
-        link_ids = db.links.find({"clusterId": cluster["_id"]}).distinct("_id")
-        db.link_performance.update_many(
-            {"linkId": {"$in": link_ids}, "deleted": {"$ne": True}},
-            {"$set": {"deleted": True, "deletedAt": now}}
+        perf_coll.update_many(
+            {"clusterId": cluster["_id"], "deleted": False},
+            {"$set": {"deleted": True, "deletedAt": now}},
+            session=session
         )
+
+    try:
+        # One transaction, so a failure part-way does not leave the cluster half deleted.
+        run_in_transaction(soft_delete)
+        invalidate_cluster(cluster["_id"])
     except Exception as e:
-        logger.error("Error deleting cluster performance data: %s", e, exc_info=True)
-        flash(request, "Error deleting cluster performance data.", "error")
+        logger.error("Error deleting cluster and its related data: %s", e, exc_info=True)
+        flash(request, "Error deleting cluster.", "error")
         return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
     
     # On successful deletion
@@ -511,23 +604,8 @@ def delete_cluster(request: Request, cluster_id: str):
 class LinksPayload(BaseModel):
     links: List[str]
 
-# Dependency for session and user validation
-def validate_session(request: Request):
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available in request.state")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    return request.state.session
-
-@router.get("/clusters/{cluster_id}/links/add-json", response_class=HTMLResponse, name="clusters_add_links_form_json")
-def add_links_form_json(request: Request, cluster_id: str):
-    try:
-        session = validate_session(request)
-    except HTTPException as e:
-        flash(request, "Your session has expired. Please log in again.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-
+@router.get("/clusters/{cluster_id}/links/add-json", response_class=HTMLResponse, name="clusters_add_links_form_json", dependencies=[Depends(require_user)])
+def add_links_form_json(request: Request, cluster_id: ObjectId = Depends(cluster_object_id)):
     # Check for Google OAuth credentials in session
     if "credentials" in request.state.session:
         flash(request, "Google OAuth credentials available.", "success")
@@ -536,8 +614,7 @@ def add_links_form_json(request: Request, cluster_id: str):
         return RedirectResponse(url=request.url_for("auth_authorize"))
 
     try:
-        db = client["apimio"]
-        cluster = db.clusters.find_one({"_id": ObjectId(cluster_id), "deleted": False})
+        cluster = clusters_coll.find_one({"_id": cluster_id, "deleted": False}, {"clusterName": 1, "domain": 1})
     except Exception as e:
         logger.error("Error retrieving cluster: %s", e, exc_info=True)
         flash(request, "Error retrieving cluster. Please try again later.", "danger")
@@ -556,21 +633,14 @@ def add_links_form_json(request: Request, cluster_id: str):
         flash(request, "There was an error loading the link creation page. Please try again.", "danger")
         raise HTTPException(status_code=500, detail="Error rendering template")
 
-@router.post("/clusters/{cluster_id}/links/add-json", name="clusters_add_links_json")
+@router.post("/clusters/{cluster_id}/links/add-json", name="clusters_add_links_json", dependencies=[Depends(require_user)])
 def add_links_json_action(
     request: Request,
-    cluster_id: str,
     payload: LinksPayload,
-    background_tasks: BackgroundTasks,
+    cluster_id: ObjectId = Depends(cluster_object_id),
 ):
     try:
-        session = validate_session(request)
-    except HTTPException:
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-
-    try:
-        db = client["apimio"]
-        cluster = db.clusters.find_one({"_id": ObjectId(cluster_id), "deleted": False})
+        cluster = clusters_coll.find_one({"_id": cluster_id, "deleted": False}, CLUSTER_GSC_PROJECTION)
     except Exception as e:
         logger.error("Error retrieving cluster: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail="Error retrieving cluster")
@@ -581,9 +651,10 @@ def add_links_json_action(
         return JSONResponse(status_code=400, content={"detail": "No links provided."})
     
     domain = cluster["domain"]
-    now = datetime.utcnow()
+    now = utc_now()
     created_links_count = 0
     errors = []
+    new_link_docs = []
 
     for url in payload.links:
         url = url.strip()
@@ -599,10 +670,10 @@ def add_links_json_action(
             continue
 
         try:
-            existing_link = db.links.find_one({
+            existing_link = links_coll.find_one({
                 "clusterId": cluster["_id"],
                 "url": url,
-                "deleted": {"$ne": True}
+                "deleted": False
             })
         except Exception as e:
             logger.error("Error checking duplicate link '%s': %s", url, e, exc_info=True)
@@ -615,7 +686,7 @@ def add_links_json_action(
 
         try:
             # Insert the link with an initial status of "processing"
-            result = db.links.insert_one({
+            new_link_doc = {
                 "clusterId": cluster["_id"],
                 "url": url,
                 "deleted": False,
@@ -623,42 +694,105 @@ def add_links_json_action(
                 "createdAt": now,
                 "updatedAt": now,
                 "status": "processing"
-            })
+            }
+            result = links_coll.insert_one(new_link_doc)
             created_links_count += 1
-            new_link_doc = db.links.find_one({"_id": result.inserted_id})
-            background_tasks.add_task(fetch_3months_gsc_data_for_link, request, new_link_doc, cluster)
+            # Hand the job the document we just wrote instead of reading it back.
+            new_link_doc["_id"] = result.inserted_id
+            new_link_docs.append(new_link_doc)
         except Exception as e:
             logger.error("Error inserting link '%s': %s", url, e, exc_info=True)
             errors.append(f"Error inserting link '{url}' into database.")
             continue
 
+    # One GSC job for all the new links of the cluster
+    submit_gsc_fetch(request, new_link_docs, cluster)
+
     response_content = {"detail": f"Added {created_links_count} link(s)."}
     if errors:
         response_content["errors"] = errors
         return JSONResponse(status_code=207, content=response_content)
     return JSONResponse(status_code=201, content=response_content)
 
-def fetch_3months_gsc_data_for_link(request: Request, link_doc: dict, cluster_doc: dict):
+# Unacknowledged (w=0) handle on links for the GSC job's status updates.
+links_status_writes = links_coll.with_options(write_concern=WriteConcern(w=0))
+
+# GSC fetches run on a dedicated, bounded pool, so the jobs don't hold request
+# threads or depend on the request. Links added together are fetched as one job.
+GSC_FETCH_WORKERS = int(os.getenv("GSC_FETCH_WORKERS", 8))
+gsc_executor = ThreadPoolExecutor(max_workers=GSC_FETCH_WORKERS, thread_name_prefix="gsc-fetch")
+
+# Rows per searchanalytics.query page (the API maximum).
+GSC_ROW_LIMIT = 25000
+# Links are matched with one anchored regex of their URLs; Search Console rejects
+# very long filter expressions, so larger batches are split across several queries.
+GSC_PAGE_REGEX_MAX_LEN = 4000
+# Concurrent searchanalytics.query calls per fetch job (one per page filter).
+GSC_QUERY_WORKERS = int(os.getenv("GSC_QUERY_WORKERS", 8))
+
+def _log_gsc_fetch_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("GSC fetch job failed: %s", future.exception(), exc_info=future.exception())
+
+def _set_links_status(link_docs: List[dict], status: str, now: Optional[datetime] = None):
+    # The status only drives the UI spinner and nothing waits on this write, so it is
+    # sent unacknowledged (see links_status_writes).
+    links_status_writes.update_many(
+        {"_id": {"$in": [doc["_id"] for doc in link_docs]}},
+        {"$set": {"status": status, "updatedAt": now or utc_now()}}
+    )
+
+def submit_gsc_fetch(request: Request, link_docs: List[dict], cluster_doc: dict):
     """
-    Fetches the last 3 months of data from GSC for the given link,
-    applying the device and country filters from cluster_doc.
-    Aggregates the data by date and stores results in the link_performance collection.
-    Updates the link's status accordingly.
+    Queues fetch_3months_gsc_data_for_links for links of one cluster on the GSC worker pool.
+    The session credentials are copied now, so the job does not touch the request after it ends.
     """
-    if not hasattr(request.state, 'session'):
-        logger.warning("Session not available; skipping GSC fetch.")
-        flash(request, "Session not available; skipping GSC data fetch.", "warning")
+    if not link_docs:
         return
-    if "credentials" not in request.state.session:
+    creds_dict = request.state.session.get("credentials")
+    if not creds_dict:
         logger.warning("No credentials in session; skipping GSC fetch.")
-        flash(request, "Google Search Console credentials not found. Please reconnect.", "danger")
-        client["apimio"].links.update_one(
-            {"_id": link_doc["_id"]},
-            {"$set": {"status": "error", "updatedAt": datetime.utcnow()}}
-        )
+        _set_links_status(link_docs, "error")
         return
+    future = gsc_executor.submit(fetch_3months_gsc_data_for_links, dict(creds_dict), link_docs, cluster_doc)
+    future.add_done_callback(_log_gsc_fetch_failure)
+
+def shutdown_gsc_executor():
+    """Stops the GSC worker pool; queued fetches that have not started are dropped."""
+    gsc_executor.shutdown(wait=False, cancel_futures=True)
+
+def _page_filters(urls: List[str]) -> List[dict]:
+    """
+    Splits urls into page filters that each match a whole batch of URLs exactly.
+    Search Console ANDs the filters of a group (there is no OR group), so a batch
+    is expressed as a single includingRegex filter '^(?:url1|url2|...)$'.
+    """
+    page_filters = []
+    batch, batch_len = [], 0
+    for url in urls:
+        pattern = re.escape(url)
+        if batch and batch_len + len(pattern) + 1 > GSC_PAGE_REGEX_MAX_LEN:
+            page_filters.append(batch)
+            batch, batch_len = [], 0
+        batch.append(pattern)
+        batch_len += len(pattern) + 1
+    if batch:
+        page_filters.append(batch)
+    return [
+        {"dimension": "page", "operator": "includingRegex", "expression": "^(?:" + "|".join(batch) + ")$"}
+        for batch in page_filters
+    ]
+
+def fetch_3months_gsc_data_for_links(creds_dict: dict, link_docs: List[dict], cluster_doc: dict):
+    """
+    Fetches the last 3 months of data from GSC for the given links of one cluster,
+    applying the device and country filters from cluster_doc.
+    All links are queried together, with rows broken down by page; the data is
+    aggregated by (link, date) and stored in the link_performance collection.
+    Updates the links' status accordingly.
+    Runs on the GSC worker pool; results are reported through the link status and the log.
+    """
     try:
-        db = client["apimio"]
         device_filter = cluster_doc.get("deviceFilter")
         country_filter_str = cluster_doc.get("countryFilter", "ALL")
         country_codes = [] if country_filter_str.upper() == "ALL" else [c.strip() for c in country_filter_str.split(",") if c.strip()]
@@ -666,165 +800,197 @@ def fetch_3months_gsc_data_for_link(request: Request, link_doc: dict, cluster_do
         start_dt = end_dt - timedelta(days=90)
         start_date_str = start_dt.isoformat()
         end_date_str = end_dt.isoformat()
-        creds_dict = request.state.session["credentials"]
 
         # Check that all necessary fields for token refresh are available
         required_keys = ["refresh_token", "token_uri", "client_id", "client_secret"]
         if not all(key in creds_dict for key in required_keys):
             logger.error("Incomplete Google OAuth credentials: missing one of %s", required_keys)
-            flash(request, "Incomplete Google OAuth credentials. Please log in again.", "danger")
-            db.links.update_one(
-                {"_id": link_doc["_id"]},
-                {"$set": {"status": "error", "updatedAt": datetime.utcnow()}}
-            )
+            _set_links_status(link_docs, "error")
             return
 
-        creds = google.oauth2.credentials.Credentials(**creds_dict)
-        service = build("webmasters", "v3", credentials=creds)
+        creds = credentials_from_dict(creds_dict)
     except Exception as e:
         logger.error("Error initializing GSC fetch: %s", e, exc_info=True)
-        flash(request, "Error initializing Google Search Console API. Try again later.", "danger")
-        db.links.update_one(
-            {"_id": link_doc["_id"]},
-            {"$set": {"status": "error", "updatedAt": datetime.utcnow()}}
-        )
+        _set_links_status(link_docs, "error")
         return
 
-    def query_for_country(country_code=None):
-        filters = [{
-            "dimension": "page",
+    links_by_url = {doc["url"]: doc for doc in link_docs}
+    page_filters = _page_filters(list(links_by_url))
+
+    # The filters shared by every page filter, built once. Search Console ANDs the
+    # filters of a group, so the selected countries are matched by a single
+    # includingRegex filter; it then returns (date, page) rows already summed over
+    # those countries, with one query per page filter instead of one per country.
+    shared_filters = []
+    if device_filter and device_filter.upper() != "ALL":
+        shared_filters.append({
+            "dimension": "device",
             "operator": "equals",
-            "expression": link_doc["url"]
-        }]
-        if device_filter and device_filter.upper() != "ALL":
-            filters.append({
-                "dimension": "device",
-                "operator": "equals",
-                "expression": device_filter
-            })
-        if country_code:
-            filters.append({
-                "dimension": "country",
-                "operator": "equals",
-                "expression": country_code
-            })
-        request_body = {
-            "startDate": start_date_str,
-            "endDate": end_date_str,
-            "dimensions": ["date"],
-            "dimensionFilterGroups": [{
-                "filters": filters
-            }]
-        }
+            "expression": device_filter
+        })
+    if country_codes:
+        shared_filters.append({
+            "dimension": "country",
+            "operator": "includingRegex",
+            # Country codes are matched case-insensitively, like the former equals filters.
+            "expression": "(?i)^(?:" + "|".join(re.escape(code) for code in country_codes) + ")$"
+        })
+    base_body = {
+        "startDate": start_date_str,
+        "endDate": end_date_str,
+        "dimensions": ["date", "page"],
+        "rowLimit": GSC_ROW_LIMIT
+    }
+    site_url = cluster_doc["domain"]
+
+    def query_pages(page_filter):
+        # Queries run on separate threads, each with its own client (see build_gsc_service).
+        service = build_gsc_service(creds)
+        filters = [page_filter, *shared_filters]
+        # Each query pages through startRow on its own copy of the body.
+        request_body = dict(base_body, dimensionFilterGroups=[{"filters": filters}], startRow=0)
+        rows = []
         try:
-            response = service.searchanalytics().query(
-                siteUrl=cluster_doc["domain"],
-                body=request_body
-            ).execute()
+            # (date, page) rows for a large batch can exceed one response page.
+            while True:
+                response = service.searchanalytics().query(
+                    siteUrl=site_url,
+                    body=request_body
+                ).execute()
+                page_rows = response.get("rows", [])
+                rows.extend(page_rows)
+                if len(page_rows) < GSC_ROW_LIMIT:
+                    return rows
+                request_body["startRow"] += GSC_ROW_LIMIT
         except Exception as e:
-            logger.error("GSC query failed for link %s, country %s: %s", link_doc.get("_id"), country_code or "ALL", e, exc_info=True)
-            flash(request, f"Failed to fetch GSC data for {link_doc.get('_id')}.", "danger")
-            return []
-        return response.get("rows", [])
-
-    all_rows = []
-    if not country_codes:
-        all_rows = query_for_country(None)
-    else:
-        for code in country_codes:
-            rows = query_for_country(code)
-            if rows:
-                all_rows.extend(rows)
+            logger.error("GSC query failed for cluster %s, countries %s: %s", cluster_doc.get("_id"), country_filter_str, e, exc_info=True)
+            failed_queries.append(page_filter)
+            return rows
+
+    failed_queries = []
 
+    # One query per page filter, issued concurrently so the job waits for the
+    # slowest query rather than the sum of them. The pool is local to the job:
+    # nesting on gsc_executor could starve it of workers.
+    with ThreadPoolExecutor(max_workers=min(GSC_QUERY_WORKERS, len(page_filters)), thread_name_prefix="gsc-query") as executor:
+        all_rows = list(chain.from_iterable(executor.map(query_pages, page_filters)))
+
+    # Aggregate per (page, date) into [clicks, impressions, impression-weighted
+    # position sum], keeping only the rows of the requested links.
     aggregated = {}
     for row in all_rows:
-        date_val = row["keys"][0]
-        clicks = row.get("clicks", 0)
+        date_val, page = row["keys"]
+        if page not in links_by_url:
+            continue
         impressions = row.get("impressions", 0)
-        position = row.get("position", 0)
-        if date_val not in aggregated:
-            aggregated[date_val] = {
-                "clicks": 0,
-                "impressions": 0,
-                "weighted_position_sum": 0
-            }
-        aggregated[date_val]["clicks"] += clicks
-        aggregated[date_val]["impressions"] += impressions
-        aggregated[date_val]["weighted_position_sum"] += position * impressions
-
-    now = datetime.utcnow()
+        totals = aggregated.get((page, date_val))
+        if totals is None:
+            totals = aggregated[(page, date_val)] = [0, 0, 0]
+        totals[0] += row.get("clicks", 0)
+        totals[1] += impressions
+        totals[2] += row.get("position", 0) * impressions
+
+    now = utc_now()
     bulk_ops = []
-    for date_val, data in aggregated.items():
-        total_clicks = data["clicks"]
-        total_impressions = data["impressions"]
+    # URL of the link each op writes to, by op index, to attribute per-op write errors.
+    op_pages = []
+    for (page, date_val), (total_clicks, total_impressions, weighted_position_sum) in aggregated.items():
         aggregated_ctr = total_clicks / total_impressions if total_impressions else 0
-        aggregated_position = data["weighted_position_sum"] / total_impressions if total_impressions else 0
+        aggregated_position = weighted_position_sum / total_impressions if total_impressions else 0
         bulk_ops.append(
             pymongo.UpdateOne(
-                {"linkId": link_doc["_id"], "date": date_val},
+                {"linkId": links_by_url[page]["_id"], "date": date_val},
                 {
                     "$set": {
                         "clicks": total_clicks,
                         "impressions": total_impressions,
                         "ctr": aggregated_ctr,
                         "position": aggregated_position,
+                        "clusterId": links_by_url[page]["clusterId"],
                         "updatedAt": now
                     },
-                    "$setOnInsert": {"createdAt": now}
+                    "$setOnInsert": {"createdAt": now, "deleted": False}
                 },
-                upsert=True
+                upsert=True,
+                namespace=perf_coll.full_name
             )
         )
+        op_pages.append(page)
+
+    # Links GSC returned no rows for had no impressions in the range, so there is
+    # nothing to store and they are complete; unless a query failed, in which case
+    # their rows may be missing.
+    fetched_pages = set(op_pages)
+    empty_links = [doc for url, doc in links_by_url.items() if url not in fetched_pages]
+    if empty_links:
+        _set_links_status(empty_links, "error" if failed_queries else "complete", now)
+
     if bulk_ops:
+        # Links that got rows are marked complete once their rows are written.
+        status_written = False
         try:
-            db.link_performance.bulk_write(bulk_ops)
-            logger.info("Aggregated and stored data for %d dates for link %s in cluster %s",
-                        len(aggregated), link_doc.get("_id"), cluster_doc.get("_id"))
-            flash(request, f"Successfully aggregated and stored data for {len(aggregated)} dates for link {link_doc.get('_id')} in cluster {cluster_doc.get('_id')}", "success")
-            # Update link status to complete
-            db.links.update_one(
-                {"_id": link_doc["_id"]},
-                {"$set": {"status": "complete", "updatedAt": datetime.utcnow()}}
-            )
+            # Each op targets a distinct (linkId, date), so the server need not apply
+            # them in order, and one failed upsert does not abort the rest.
+            if SUPPORTS_CLIENT_BULK_WRITE:
+                # The upserts and the links' status update go out as one bulkWrite command.
+                result = client.bulk_write(bulk_ops + [pymongo.UpdateMany(
+                    {"_id": {"$in": [links_by_url[page]["_id"] for page in fetched_pages]}},
+                    {"$set": {"status": "complete", "updatedAt": now}},
+                    namespace=links_coll.full_name
+                )], ordered=False)
+                status_written = True
+            else:
+                result = perf_coll.bulk_write(bulk_ops, ordered=False)
+            logger.info("Aggregated and stored %d (link, date) rows for %d link(s) in cluster %s (%d upserted, %d modified)",
+                        len(aggregated), len(fetched_pages), cluster_doc.get("_id"),
+                        result.upserted_count, result.modified_count)
+            failed_pages = set()
+        except (BulkWriteError, ClientBulkWriteException) as e:
+            if isinstance(e, BulkWriteError):
+                failed_indexes = [err["index"] for err in e.details.get("writeErrors", [])]
+            else:
+                failed_indexes = [err["idx"] for err in e.write_errors or []]
+            # An error on the trailing status update has no link row to attribute.
+            failed_pages = {op_pages[i] for i in failed_indexes if i < len(op_pages)}
+            if not failed_pages:
+                # e.g. a write concern error: nothing to attribute to a single link.
+                failed_pages = fetched_pages
+            # The other ops were still applied (unordered), so only these links are marked as failed.
+            logger.error("Error writing aggregated data for %d link(s) in cluster %s (%d failed op(s)): %s",
+                         len(failed_pages), cluster_doc.get("_id"), len(failed_indexes), e, exc_info=True)
         except Exception as e:
-            logger.error("Error writing aggregated data for link %s: %s", link_doc.get("_id"), e, exc_info=True)
-            flash(request, "Failed to store fetched GSC data. Please try again later.", "danger")
-            db.links.update_one(
-                {"_id": link_doc["_id"]},
-                {"$set": {"status": "error", "updatedAt": datetime.utcnow()}}
-            )
-
+            logger.error("Error writing aggregated data for cluster %s: %s", cluster_doc.get("_id"), e, exc_info=True)
+            failed_pages = fetched_pages
+        # Update link status to complete (or error for links whose writes failed)
+        if fetched_pages - failed_pages and not status_written:
+            _set_links_status([links_by_url[page] for page in fetched_pages - failed_pages], "complete", now)
+        if failed_pages:
+            _set_links_status([links_by_url[page] for page in failed_pages], "error", now)
 
-@router.post("/clusters/{cluster_id}/links/{link_id}/refresh", name="clusters_refresh_link_gsc")
-def refresh_link_gsc(request: Request, cluster_id: str, link_id: str, background_tasks: BackgroundTasks):
-    try:
-        # Validate session and user
-        session = validate_session(request)
-    except HTTPException:
-        return RedirectResponse(url=request.url_for("auth_authorize"))
 
+@router.post("/clusters/{cluster_id}/links/{link_id}/refresh", name="clusters_refresh_link_gsc", dependencies=[Depends(require_user)])
+def refresh_link_gsc(request: Request, cluster_id: ObjectId = Depends(cluster_object_id), link_id: ObjectId = Depends(link_object_id)):
     try:
-        db = client["apimio"]
-        # Retrieve the cluster; ensure it exists and is not deleted.
-        cluster = db.clusters.find_one({"_id": ObjectId(cluster_id), "deleted": False})
-        if not cluster:
-            raise HTTPException(status_code=404, detail="Cluster not found or deleted")
-        # Retrieve the link; ensure it exists and is not marked as deleted.
-        link_doc = db.links.find_one({"_id": ObjectId(link_id), "deleted": {"$ne": True}})
-        if not link_doc:
-            raise HTTPException(status_code=404, detail="Link not found or deleted")
+        # Retrieve the cluster, and the link only if it is an active link of that cluster
+        # (the fetch stamps the cluster's id on the link's performance rows).
+        cluster = get_cluster(cluster_id)
+        link_doc = links_coll.find_one({"_id": link_id, "clusterId": cluster_id, "deleted": False})
     except Exception as e:
         logger.error("Error retrieving cluster or link: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail="Error retrieving cluster or link")
+    if not cluster or cluster.get("deleted"):
+        raise HTTPException(status_code=404, detail="Cluster not found or deleted")
+    if not link_doc:
+        raise HTTPException(status_code=404, detail="Link not found in this cluster or deleted")
 
     # Update the link's status to "processing" so the spinner can be displayed.
-    db.links.update_one(
+    links_coll.update_one(
         {"_id": link_doc["_id"]},
-        {"$set": {"status": "processing", "updatedAt": datetime.utcnow()}}
+        {"$set": {"status": "processing", "updatedAt": utc_now()}}
     )
 
-    # Offload the GSC data fetch to a background task.
-    background_tasks.add_task(fetch_3months_gsc_data_for_link, request, link_doc, cluster)
+    # Offload the GSC data fetch to the GSC worker pool.
+    submit_gsc_fetch(request, [link_doc], cluster)
 
     flash(request, "GSC data refresh initiated.", "info")
 
@@ -836,21 +1002,13 @@ def refresh_link_gsc(request: Request, cluster_id: str, link_id: str, background
 
 
 
-@router.get("/links/{link_id}/edit", response_class=HTMLResponse, name="clusters_edit_link_form")
-def edit_link_form(request: Request, link_id: str):
+@router.get("/links/{link_id}/edit", response_class=HTMLResponse, name="clusters_edit_link_form", dependencies=[Depends(require_user)])
+def edit_link_form(request: Request, link_id: ObjectId = Depends(link_object_id)):
     """
     GET route to show a form for editing a link's URL.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available in request.state")
-        flash(request, "Session not available. Please log in again.", "warning")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session:
-        flash(request, "You need to log in to edit a link.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        db = client["apimio"]
-        link_doc = db.links.find_one({"_id": ObjectId(link_id)})
+        link_doc = links_coll.find_one({"_id": link_id})
     except Exception as e:
         logger.error("Error retrieving link: %s", e, exc_info=True)
         flash(request, "There was an error retrieving link details. Please try again later.", "danger")
@@ -859,12 +1017,12 @@ def edit_link_form(request: Request, link_id: str):
         flash(request, "The requested link does not exist.", "danger")
         raise HTTPException(status_code=404, detail="Link not found")
     try:
-        cluster = db.clusters.find_one({"_id": link_doc["clusterId"], "deleted": False})
+        cluster = get_cluster(link_doc["clusterId"])
     except Exception as e:
         logger.error("Error retrieving cluster for link: %s", e, exc_info=True)
         flash(request, "Error retrieving cluster for link.", "danger")
         raise HTTPException(status_code=500, detail="Error retrieving cluster for link")
-    if not cluster:
+    if not cluster or cluster.get("deleted"):
         flash(request, "The associated cluster for this link was deleted.", "danger")
         raise HTTPException(status_code=404, detail="Cluster not found or deleted for this link")
     try:
@@ -880,26 +1038,18 @@ def edit_link_form(request: Request, link_id: str):
         raise HTTPException(status_code=500, detail="Error rendering edit link form")
 
 
-@router.post("/links/{link_id}/edit", name="clusters_edit_link_action")
+@router.post("/links/{link_id}/edit", name="clusters_edit_link_action", dependencies=[Depends(require_user)])
 def edit_link_action(
     request: Request,
-    link_id: str,
+    link_id: ObjectId = Depends(link_object_id),
     url: str = Form(...)
 ):
     """
     POST route to update a link's URL, ensuring domain consistency
     and no duplication within the same cluster.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available in request.state")
-        flash(request, "Session not available. Please log in again.", "warning")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session:
-        flash(request, "You need to log in to edit a link.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        db = client["apimio"]
-        link_doc = db.links.find_one({"_id": ObjectId(link_id)})
+        link_doc = links_coll.find_one({"_id": link_id})
     except Exception as e:
         logger.error("Error retrieving link for editing: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail="Error retrieving link for editing")
@@ -907,11 +1057,11 @@ def edit_link_action(
         flash(request, "The requested link does not exist.", "danger")
         raise HTTPException(status_code=404, detail="Link not found")
     try:
-        cluster = db.clusters.find_one({"_id": link_doc["clusterId"], "deleted": False})
+        cluster = get_cluster(link_doc["clusterId"])
     except Exception as e:
         logger.error("Error retrieving cluster for editing: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail="Error retrieving cluster for editing")
-    if not cluster:
+    if not cluster or cluster.get("deleted"):
         flash(request, "The associated cluster for this link was deleted.", "danger")
         raise HTTPException(status_code=404, detail="Cluster not found or deleted for this link")
     
@@ -923,30 +1073,25 @@ def edit_link_action(
         if not check_domain_consistency(cluster["domain"], new_url):
             flash(request, f"Link '{new_url}' does not match the cluster domain '{cluster['domain']}'.", "danger")
             raise HTTPException(status_code=400, detail=f"Link '{new_url}' does not match domain '{cluster['domain']}'")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error("Error checking domain consistency for link edit: %s", e, exc_info=True)
-        flash(request, f"Link '{new_url}' already exists in this cluster.", "danger")
+        flash(request, "An error occurred while checking the link's domain. Please try again.", "danger")
         raise HTTPException(status_code=400, detail="Error checking domain consistency")
     try:
-        existing_same = db.links.find_one({
-            "_id": {"$ne": link_doc["_id"]},
-            "clusterId": cluster["_id"],
-            "url": new_url,
-            "deleted": {"$ne": True}
-        })
-    except Exception as e:
-        logger.error("Error checking duplicate link during edit: %s", e, exc_info=True)
-        raise HTTPException(status_code=500, detail="Error checking for duplicate link")
-    if existing_same:
-        raise HTTPException(status_code=400, detail=f"Link '{new_url}' already exists in this cluster.")
-    try:
-        db.links.update_one(
+        # Duplicates among the cluster's active links are rejected by the unique index
+        # on (clusterId, url), so the update itself is the duplicate check.
+        links_coll.update_one(
             {"_id": link_doc["_id"]},
             {"$set": {
                 "url": new_url,
-                "updatedAt": datetime.utcnow()
+                "updatedAt": utc_now()
             }}
         )
+    except DuplicateKeyError:
+        flash(request, f"Link '{new_url}' already exists in this cluster.", "danger")
+        raise HTTPException(status_code=400, detail=f"Link '{new_url}' already exists in this cluster.")
     except Exception as e:
         logger.error("Error updating link URL: %s", e, exc_info=True)
         flash(request, "An error occurred while updating the link. Please try again.", "danger")
@@ -962,22 +1107,14 @@ def edit_link_action(
         raise HTTPException(status_code=500, detail="Error redirecting after editing link")
 
 
-@router.post("/links/{link_id}/delete", name="clusters_delete_link")
-def delete_link(request: Request, link_id: str):
+@router.post("/links/{link_id}/delete", name="clusters_delete_link", dependencies=[Depends(require_user)])
+def delete_link(request: Request, link_id: ObjectId = Depends(link_object_id)):
     """
     Soft-delete a single link and its performance data.
     Marks the link and its associated performance data as deleted.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not available in request.state")
-        flash(request, "Session not available. Please log in again.", "warning")
-        raise HTTPException(status_code=500, detail="Session not available")
-    if "user_id" not in request.state.session:
-        flash(request, "You need to log in to delete a link.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        db = client["apimio"]
-        link_doc = db.links.find_one({"_id": ObjectId(link_id), "deleted": {"$ne": True}})
+        link_doc = links_coll.find_one({"_id": link_id, "deleted": False})
     except Exception as e:
         logger.error("Error retrieving link for deletion: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail="Error retrieving link for deletion")
@@ -990,9 +1127,9 @@ def delete_link(request: Request, link_id: str):
         logger.error("Error retrieving cluster ID from link: %s", e, exc_info=True)
         flash(request, "Error retrieving cluster information for this link.", "danger")
         raise HTTPException(status_code=500, detail="Error retrieving cluster ID")
-    now = datetime.utcnow()
+    now = utc_now()
     try:
-        db.links.update_one(
+        links_coll.update_one(
             {"_id": link_doc["_id"]},
             {"$set": {"deleted": True, "deletedAt": now}}
         )
@@ -1001,8 +1138,8 @@ def delete_link(request: Request, link_id: str):
         flash(request, "An error occurred while deleting the link. Please try again.", "danger")
         raise HTTPException(status_code=500, detail="Error deleting link")
     try:
-        db.link_performance.update_many(
-            {"linkId": link_doc["_id"], "deleted": {"$ne": True}},
+        perf_coll.update_many(
+            {"linkId": link_doc["_id"], "deleted": False},
             {"$set": {"deleted": True, "deletedAt": now}}
         )
     except Exception as e:
@@ -1025,10 +1162,10 @@ def delete_link(request: Request, link_id: str):
 # -----------------------------------------
 
 
-@router.get("/links/{link_id}/performance", response_class=HTMLResponse, name="clusters_link_performance")
+@router.get("/links/{link_id}/performance", response_class=HTMLResponse, name="clusters_link_performance", dependencies=[Depends(require_user)])
 def link_performance(
     request: Request,
-    link_id: str,
+    link_id: ObjectId = Depends(link_object_id),
     end: str = Query(None),
     start: str = Query(None)
 ):
@@ -1036,10 +1173,6 @@ def link_performance(
     Display aggregated performance data for a link from the local DB.
     Data is already aggregated by date based on the cluster's deviceFilter and multi-countryFilter.
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You need to log in to view link performance.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-    
     # 1. Parse date range (defaulting to last 3 months if not provided)
     try:
         if not end or not start:
@@ -1055,8 +1188,7 @@ def link_performance(
         raise HTTPException(status_code=400, detail="Invalid date range parameters")
     
     try:
-        db = client["apimio"]
-        link_doc = db.links.find_one({"_id": ObjectId(link_id)})
+        link_doc = links_coll.find_one({"_id": link_id}, {"url": 1, "clusterId": 1})
         if not link_doc:
             flash(request, "The requested link was not found.", "danger")
             raise HTTPException(status_code=404, detail="Link not found")
@@ -1065,7 +1197,7 @@ def link_performance(
         raise HTTPException(status_code=500, detail="Error retrieving link information")
     
     try:
-        cluster = db.clusters.find_one({"_id": link_doc["clusterId"]})
+        cluster = get_cluster(link_doc["clusterId"])
         if not cluster:
             flash(request, "No cluster found for this link. It may have been deleted.", "danger")
             raise HTTPException(status_code=404, detail="Cluster not found for this link")
@@ -1078,14 +1210,20 @@ def link_performance(
     perf_query = {
         "linkId": link_doc["_id"],
         "date": {"$gte": start_date, "$lte": end_date},
-        "deleted": {"$ne": True}
+        "deleted": False
     }
     
     try:
-        # 3. Query local DB, sort by date descending (newest first)
-        perf_docs = list(db.link_performance.find(perf_query).sort("date", -1))
-        if not perf_docs:
-         flash(request, "No performance data available for the selected date range.", "info")
+        # 3. Query local DB, sort by date descending (newest first). The template iterates
+        # the rows once, so they are streamed from the cursor rather than collected into
+        # a list; the first row is read up front to know whether there is any data.
+        perf_cursor = perf_coll.find(perf_query, PERF_ROW_PROJECTION).sort("date", -1).batch_size(PERF_CURSOR_BATCH_SIZE)
+        first_doc = next(perf_cursor, None)
+        if first_doc is None:
+            flash(request, "No performance data available for the selected date range.", "info")
+            perf_docs = []
+        else:
+            perf_docs = chain((first_doc,), perf_cursor)
     except Exception as e:
         logger.error("Error querying performance data: %s", e, exc_info=True)
         flash(request, "An error occurred while displaying performance data.", "danger")
@@ -1110,10 +1248,10 @@ def link_performance(
             raise HTTPException(status_code=500, detail="Error rendering performance page")
 
 
-@router.get("/clusters/{cluster_id}/performance", response_class=HTMLResponse, name="clusters_cluster_performance")
+@router.get("/clusters/{cluster_id}/performance", response_class=HTMLResponse, name="clusters_cluster_performance", dependencies=[Depends(require_user)])
 def cluster_performance(
     request: Request,
-    cluster_id: str,
+    cluster_id: ObjectId = Depends(cluster_object_id),
     end: str = Query(None),
     start: str = Query(None)
 ):
@@ -1123,15 +1261,10 @@ def cluster_performance(
     aggregating link-level data. The user can only select a date range (start, end),
     defaulting to the last 3 months.
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You need to log in to view cluster performance.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
-    
     try:
-        db = client["apimio"]
         # Find the cluster (ensure it's not deleted)
-        cluster = db.clusters.find_one({"_id": ObjectId(cluster_id), "deleted": False})
-        if not cluster:
+        cluster = get_cluster(cluster_id)
+        if not cluster or cluster.get("deleted"):
             flash(request, "The requested cluster was not found or has been deleted.", "danger")
             raise HTTPException(status_code=404, detail="Cluster not found or deleted.")
     except Exception as e:
@@ -1152,80 +1285,44 @@ def cluster_performance(
         flash(request, "Invalid date range provided. Please select a valid range.", "danger")
         raise HTTPException(status_code=400, detail="Invalid date range parameters")
     
-    try:
-        # 2. Gather all link IDs in this cluster
-        link_ids = db.links.find({
-            "clusterId": cluster["_id"],
-            "deleted": False
-        }).distinct("_id")
-        if not link_ids:
-            flash(request, "No links found in this cluster.", "info")
-    except Exception as e:
-        logger.error("Error retrieving link IDs for cluster: %s", e, exc_info=True)
-        flash(request, "An error occurred while retrieving performance data. Please try again.", "danger")
-        raise HTTPException(status_code=500, detail="Error retrieving cluster link IDs")
-    
-    # 3. Build the performance query.
+    # 2. Build the performance query. Rows carry their link's clusterId, and trashing a
+    # link trashes its rows, so the cluster's active rows are matched without first
+    # collecting its link IDs.
     perf_query = {
-        "linkId": {"$in": link_ids},
+        "clusterId": cluster["_id"],
         "date": {"$gte": start_date, "$lte": end_date},
-        "deleted": {"$ne": True}
+        "deleted": False
     }
     
     try:
-        # 4. Fetch performance data from the DB
-        perf_docs = list(db.link_performance.find(perf_query))
-        if not perf_docs:
+        # 3. Aggregate performance by date across all links on the server: one row per
+        # date, with the position weighted by impressions, newest first.
+        result_rows = list(perf_coll.aggregate([
+            {"$match": perf_query},
+            {"$group": {
+                "_id": "$date",
+                "clicks": {"$sum": "$clicks"},
+                "impressions": {"$sum": "$impressions"},
+                "weighted_position_sum": {"$sum": {"$multiply": ["$position", "$impressions"]}}
+            }},
+            {"$project": {
+                "_id": 0,
+                "date": "$_id",
+                "clicks": 1,
+                "impressions": 1,
+                "ctr": {"$cond": [{"$eq": ["$impressions", 0]}, 0, {"$divide": ["$clicks", "$impressions"]}]},
+                "position": {"$cond": [{"$eq": ["$impressions", 0]}, 0, {"$divide": ["$weighted_position_sum", "$impressions"]}]}
+            }},
+            {"$sort": {"date": -1}}
+        ]))
+        if not result_rows:
             flash(request, "No performance data available for the selected date range.", "info")
-    except Exception as e:
-        logger.error("Error querying performance data: %s", e, exc_info=True)
-        raise HTTPException(status_code=500, detail="Error retrieving performance data")
-    
-    # 5. Aggregate performance by date across all links
-    aggregated = {}
-    try:
-        for doc in perf_docs:
-            d = doc["date"]
-            if d not in aggregated:
-                aggregated[d] = {
-                    "clicks": 0,
-                    "impressions": 0,
-                    "weighted_position_sum": 0.0
-                }
-            clicks = doc.get("clicks", 0)
-            impressions = doc.get("impressions", 0)
-            position = doc.get("position", 0)
-            aggregated[d]["clicks"] += clicks
-            aggregated[d]["impressions"] += impressions
-            aggregated[d]["weighted_position_sum"] += position * impressions
     except Exception as e:
         logger.error("Error aggregating performance data: %s", e, exc_info=True)
-        flash(request, "An error occurred while aggregating performance data.", "danger")
-        raise HTTPException(status_code=500, detail="Error aggregating performance data")
-    
-    # 6. Prepare aggregated result rows
-    result_rows = []
-    try:
-        for d, data in aggregated.items():
-            total_clicks = data["clicks"]
-            total_impressions = data["impressions"]
-            aggregated_ctr = total_clicks / total_impressions if total_impressions else 0
-            aggregated_position = data["weighted_position_sum"] / total_impressions if total_impressions else 0
-            result_rows.append({
-                "date": d,
-                "clicks": total_clicks,
-                "impressions": total_impressions,
-                "ctr": aggregated_ctr,
-                "position": aggregated_position
-            })
-        # Sort results by date descending (newest first)
-        result_rows.sort(key=lambda x: x["date"], reverse=True)
-    except Exception as e:
-        logger.error("Error preparing aggregated results: %s", e, exc_info=True)
-        raise HTTPException(status_code=500, detail="Error preparing aggregated performance results")
+        raise HTTPException(status_code=500, detail="Error retrieving performance data")
     
     try:
-        # 7. Render the cluster performance template
+        # 4. Render the cluster performance template
         return templates.TemplateResponse(
             "Dashboard/Performance/cluster_performance.html",
             {
@@ -1249,52 +1346,37 @@ def cluster_performance(
 
 
 @router.post("/clusters/{cluster_id}/trash", name="clusters_trash_cluster")
-def trash_cluster(request: Request, cluster_id: str):
+def trash_cluster(request: Request, cluster_id: ObjectId = Depends(cluster_object_id), user_id: ObjectId = Depends(require_user)):
     """
     Moves the cluster to trash (soft-delete).
     Marks the cluster, all its links, and their performance data as deleted=true.
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You must be logged in to perform this action.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
+    now = utc_now()
     try:
-        user_id = request.state.session["user_id"]
-        db = client["apimio"]
+        # Mark cluster as trashed; the filter is the ownership and state check, so no
+        # separate read is needed
+        result = clusters_coll.update_one(
+            {"_id": cluster_id, "userId": user_id, "deleted": False},
+            {"$set": {"deleted": True, "deletedAt": now}}
+        )
     except Exception as e:
-        logger.error("Error accessing session or DB: %s", e, exc_info=True)
-        flash(request, "Internal error accessing session or database.", "error")
+        logger.error("Error trashing cluster: %s", e, exc_info=True)
+        flash(request, "Error trashing cluster and its related data.", "error")
         return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
-    
-    try:
-        cluster = db.clusters.find_one({
-            "_id": ObjectId(cluster_id),
-            "userId": ObjectId(user_id),
-            "deleted": {"$ne": True}
-        })
-        if not cluster:
-            flash(request, "Cluster not found or already trashed.", "error")
-            return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
-    except Exception as e:
-        logger.error("Error retrieving cluster: %s", e, exc_info=True)
-        flash(request, "Error retrieving cluster.", "error")
+    if not result.matched_count:
+        flash(request, "Cluster not found or already trashed.", "error")
         return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
-    
-    now = datetime.utcnow()
+
     try:
-        # Mark cluster as trashed
-        db.clusters.update_one(
-            {"_id": cluster["_id"]},
-            {"$set": {"deleted": True, "deletedAt": now}}
-        )
+        invalidate_cluster(cluster_id)
         # Trash all links under this cluster
-        db.links.update_many(
-            {"clusterId": cluster["_id"], "deleted": {"$ne": True}},
+        links_coll.update_many(
+            {"clusterId": cluster_id, "deleted": False},
             {"$set": {"deleted": True, "deletedAt": now}}
         )
         # Trash performance data for these links
-        link_ids = db.links.find({"clusterId": cluster["_id"]}).distinct("_id")
-        db.link_performance.update_many(
-            {"linkId": {"$in": link_ids}, "deleted": {"$ne": True}},
+        perf_coll.update_many(
+            {"clusterId": cluster_id, "deleted": False},
             {"$set": {"deleted": True, "deletedAt": now}}
         )
     except Exception as e:
@@ -1311,51 +1393,67 @@ def trash_cluster(request: Request, cluster_id: str):
         return RedirectResponse(url=request.url_for("clusters_list_clusters"), status_code=303)
 
 @router.post("/clusters/{cluster_id}/restore", name="clusters_restore_cluster")
-def restore_cluster(request: Request, cluster_id: str):
+def restore_cluster(request: Request, cluster_id: ObjectId = Depends(cluster_object_id), user_id: ObjectId = Depends(require_user)):
     """
     Restores a trashed cluster and all associated links + performance data.
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You need to log in to restore a cluster.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        user_id = request.state.session["user_id"]
-        db = client["apimio"]
-        cluster = db.clusters.find_one({
-            "_id": ObjectId(cluster_id),
-            "userId": ObjectId(user_id),
-            "deleted": True
-        })
-        if not cluster:
-            flash(request, "The cluster was not found or is not in the trash.", "danger")
-            raise HTTPException(status_code=404, detail="Cluster not found or not trashed.")
+        cluster = clusters_coll.find_one({"_id": cluster_id, "userId": user_id, "deleted": True}, {"_id": 1})
+        # Trashed links, newest deletedAt first: links trashed with the cluster come before
+        # links the user had trashed on their own earlier.
+        trashed_links = list(links_coll.find(
+            {"clusterId": cluster_id, "deleted": True},
+            {"url": 1}
+        ).sort("deletedAt", -1)) if cluster else []
+        active_urls = {doc["url"] for doc in links_coll.find({"clusterId": cluster_id, "deleted": False}, {"url": 1})} if cluster else set()
     except Exception as e:
         logger.error("Error retrieving trashed cluster: %s", e, exc_info=True)
         flash(request, "An error occurred while retrieving the trashed cluster.", "danger")
         raise HTTPException(status_code=500, detail="Error retrieving trashed cluster")
-    
+    if not cluster:
+        flash(request, "The cluster was not found or is not in the trash.", "danger")
+        raise HTTPException(status_code=404, detail="Cluster not found or not trashed.")
+
+    # The unique index on active (clusterId, url) allows one active link per URL. A link
+    # trashed on its own and then added again leaves two trashed links with that URL;
+    # only the newest is restored, the others stay in the trash.
+    restore_ids, conflicting_urls = [], set()
+    for doc in trashed_links:
+        if doc["url"] in active_urls:
+            conflicting_urls.add(doc["url"])
+        else:
+            active_urls.add(doc["url"])
+            restore_ids.append(doc["_id"])
+
     try:
-        # Restore cluster
-        db.clusters.update_one(
-            {"_id": cluster["_id"]},
-            {"$set": {"deleted": False, "deletedAt": None}}
-        )
-        # Restore links
-        db.links.update_many(
-            {"clusterId": cluster["_id"], "deleted": True},
-            {"$set": {"deleted": False, "deletedAt": None}}
-        )
-        # Restore performance data
-        link_ids = db.links.find({"clusterId": cluster["_id"]}).distinct("_id")
-        db.link_performance.update_many(
-            {"linkId": {"$in": link_ids}, "deleted": True},
+        # Links first, then their performance data, then the cluster, so a failure
+        # part-way leaves the cluster in the trash and the restore can be retried.
+        if restore_ids:
+            links_coll.update_many(
+                {"_id": {"$in": restore_ids}, "deleted": True},
+                {"$set": {"deleted": False, "deletedAt": None}}
+            )
+            perf_coll.update_many(
+                {"linkId": {"$in": restore_ids}, "deleted": True},
+                {"$set": {"deleted": False, "deletedAt": None}}
+            )
+        clusters_coll.update_one(
+            {"_id": cluster_id, "deleted": True},
             {"$set": {"deleted": False, "deletedAt": None}}
         )
+        invalidate_cluster(cluster_id)
+    except DuplicateKeyError:
+        # A link with one of these URLs became active meanwhile.
+        flash(request, "A link in this cluster was changed while restoring it. Please try again.", "danger")
+        raise HTTPException(status_code=409, detail="A link URL of this cluster became active during the restore.")
     except Exception as e:
         logger.error("Error restoring cluster: %s", e, exc_info=True)
         flash(request, "An error occurred while restoring the cluster. Please try again.", "danger")
         raise HTTPException(status_code=500, detail="Error restoring cluster")
-    
+
+    if conflicting_urls:
+        flash(request, f"Older trashed copies of {len(conflicting_urls)} link URL(s) were left in the trash, as the URL is already active in the cluster: {', '.join(sorted(conflicting_urls))}", "warning")
+
     try:
         flash(request, "Cluster and all associated data successfully restored!", "success")
         return RedirectResponse(url=request.url_for("clusters_show_cluster", cluster_id=cluster_id), status_code=303)
@@ -1365,20 +1463,16 @@ def restore_cluster(request: Request, cluster_id: str):
         raise HTTPException(status_code=500, detail="Error redirecting after restoration")
 
 @router.post("/clusters/{cluster_id}/delete-permanently", name="clusters_delete_cluster_permanently")
-def delete_cluster_permanently(request: Request, cluster_id: str):
+def delete_cluster_permanently(request: Request, cluster_id: ObjectId = Depends(cluster_object_id), user_id: ObjectId = Depends(require_user)):
     """
     Physically removes the cluster doc, links, and performance data from DB.
-    Typically used after a 30-day grace period or user confirmation.
+    Used when the user purges it from the trash; otherwise the deletedAt TTL
+    indexes (db_client.py) remove it TRASH_RETENTION_DAYS after it was trashed.
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You need to log in to delete a cluster permanently.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        user_id = request.state.session["user_id"]
-        db = client["apimio"]
-        cluster = db.clusters.find_one({
-            "_id": ObjectId(cluster_id),
-            "userId": ObjectId(user_id),
+        cluster = clusters_coll.find_one({
+            "_id": cluster_id,
+            "userId": user_id,
             "deleted": True
         })
         if not cluster:
@@ -1390,13 +1484,15 @@ def delete_cluster_permanently(request: Request, cluster_id: str):
         raise HTTPException(status_code=500, detail="Error retrieving trashed cluster")
     
     try:
-        link_ids = db.links.find({"clusterId": cluster["_id"]}).distinct("_id")
-        # Remove performance data
-        db.link_performance.delete_many({"linkId": {"$in": link_ids}})
-        # Remove links
-        db.links.delete_many({"clusterId": cluster["_id"]})
-        # Remove cluster
-        db.clusters.delete_one({"_id": cluster["_id"]})
+        # Remove performance data, then links, then the cluster. Children go first and
+        # the batch is ordered, so a failure part-way leaves the cluster in the trash
+        # and the delete can be retried.
+        write_in_order(
+            (perf_coll, pymongo.DeleteMany({"clusterId": cluster["_id"]}, namespace=perf_coll.full_name)),
+            (links_coll, pymongo.DeleteMany({"clusterId": cluster["_id"]}, namespace=links_coll.full_name)),
+            (clusters_coll, pymongo.DeleteOne({"_id": cluster["_id"]}, namespace=clusters_coll.full_name))
+        )
+        invalidate_cluster(cluster["_id"])
     except Exception as e:
         logger.error("Error permanently deleting cluster: %s", e, exc_info=True)
         flash(request, "An error occurred while permanently deleting the cluster. Please try again.", "danger")
@@ -1411,21 +1507,16 @@ def delete_cluster_permanently(request: Request, cluster_id: str):
         raise HTTPException(status_code=500, detail="Error redirecting after deletion")
 
 @router.post("/links/{link_id}/trash", name="clusters_trash_link")
-def trash_link(request: Request, link_id: str):
+def trash_link(request: Request, link_id: ObjectId = Depends(link_object_id), user_id: ObjectId = Depends(require_user)):
     """
     Moves the link to trash (soft-delete).
     Marks the link and its performance data as deleted=true.
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You need to log in to trash a link.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        user_id = request.state.session["user_id"]
-        db = client["apimio"]
-        link_doc = db.links.find_one({
-            "_id": ObjectId(link_id),
-            "deleted": {"$ne": True}
-        })
+        link_doc = links_coll.find_one({
+            "_id": link_id,
+            "deleted": False
+        }, {"clusterId": 1})
         if not link_doc:
             flash(request, "The link was not found or is already trashed.", "danger")
             raise HTTPException(status_code=404, detail="Link not found or already trashed.")
@@ -1435,12 +1526,10 @@ def trash_link(request: Request, link_id: str):
         raise HTTPException(status_code=500, detail="Error retrieving link for trashing")
     
     try:
-        # Ensure the cluster belongs to this user
-        cluster = db.clusters.find_one({
-            "_id": link_doc["clusterId"],
-            "userId": ObjectId(user_id)
-        })
-        if not cluster:
+        # Ensure the cluster belongs to this user (a cluster's owner never changes,
+        # so the cached doc is enough)
+        cluster = get_cluster(link_doc["clusterId"])
+        if not cluster or cluster["userId"] != user_id:
             flash(request, "You do not have permission to trash this link.", "danger")
             raise HTTPException(status_code=403, detail="This link's cluster does not belong to the current user.")
     except Exception as e:
@@ -1448,17 +1537,20 @@ def trash_link(request: Request, link_id: str):
         flash(request, "An error occurred while verifying the link's cluster.", "danger")
         raise HTTPException(status_code=500, detail="Error verifying link's cluster")
     
-    now = datetime.utcnow()
+    now = utc_now()
     try:
-        # Mark the link as trashed
-        db.links.update_one(
-            {"_id": link_doc["_id"]},
-            {"$set": {"deleted": True, "deletedAt": now}}
-        )
-        # Trash performance data for this link
-        db.link_performance.update_many(
-            {"linkId": link_doc["_id"], "deleted": {"$ne": True}},
-            {"$set": {"deleted": True, "deletedAt": now}}
+        # Mark the link as trashed, then its performance data
+        write_in_order(
+            (links_coll, pymongo.UpdateOne(
+                {"_id": link_doc["_id"]},
+                {"$set": {"deleted": True, "deletedAt": now}},
+                namespace=links_coll.full_name
+            )),
+            (perf_coll, pymongo.UpdateMany(
+                {"linkId": link_doc["_id"], "deleted": False},
+                {"$set": {"deleted": True, "deletedAt": now}},
+                namespace=perf_coll.full_name
+            ))
         )
     except Exception as e:
         logger.error("Error trashing link and its performance data: %s", e, exc_info=True)
@@ -1477,21 +1569,16 @@ def trash_link(request: Request, link_id: str):
         raise HTTPException(status_code=500, detail="Error redirecting after trashing link")
 
 @router.post("/links/{link_id}/restore", name="clusters_restore_link")
-def restore_link(request: Request, link_id: str):
+def restore_link(request: Request, link_id: ObjectId = Depends(link_object_id), user_id: ObjectId = Depends(require_user)):
     """
     Restores a trashed link (deleted=true => deleted=false),
     also restores its performance data.
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You need to log in to restore a link.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        user_id = request.state.session["user_id"]
-        db = client["apimio"]
-        link_doc = db.links.find_one({
-            "_id": ObjectId(link_id),
+        link_doc = links_coll.find_one({
+            "_id": link_id,
             "deleted": True
-        })
+        }, {"clusterId": 1})
         if not link_doc:
             flash(request, "The link was not found or is not in trash.", "danger")
             raise HTTPException(status_code=404, detail="Link not found or not in trash.")
@@ -1501,12 +1588,10 @@ def restore_link(request: Request, link_id: str):
         raise HTTPException(status_code=500, detail="Error retrieving trashed link")
     
     try:
-        # Ensure the cluster belongs to this user
-        cluster = db.clusters.find_one({
-            "_id": link_doc["clusterId"],
-            "userId": ObjectId(user_id)
-        })
-        if not cluster:
+        # Ensure the cluster belongs to this user (a cluster's owner never changes,
+        # so the cached doc is enough)
+        cluster = get_cluster(link_doc["clusterId"])
+        if not cluster or cluster["userId"] != user_id:
             flash(request, "You do not have permission to restore this link.", "danger")
             raise HTTPException(status_code=403, detail="This link's cluster does not belong to the current user.")
     except Exception as e:
@@ -1516,14 +1601,22 @@ def restore_link(request: Request, link_id: str):
     
     try:
         # Restore link and its performance data
-        db.links.update_one(
-            {"_id": link_doc["_id"]},
-            {"$set": {"deleted": False, "deletedAt": None}}
-        )
-        db.link_performance.update_many(
-            {"linkId": link_doc["_id"], "deleted": True},
-            {"$set": {"deleted": False, "deletedAt": None}}
+        write_in_order(
+            (links_coll, pymongo.UpdateOne(
+                {"_id": link_doc["_id"]},
+                {"$set": {"deleted": False, "deletedAt": None}},
+                namespace=links_coll.full_name
+            )),
+            (perf_coll, pymongo.UpdateMany(
+                {"linkId": link_doc["_id"], "deleted": True},
+                {"$set": {"deleted": False, "deletedAt": None}},
+                namespace=perf_coll.full_name
+            ))
         )
+    except DuplicateKeyError:
+        # The unique index on active (clusterId, url) found the URL re-added to the cluster.
+        flash(request, "This link's URL has been added to the cluster again; it cannot be restored.", "danger")
+        raise HTTPException(status_code=400, detail="An active link with this URL already exists in the cluster.")
     except Exception as e:
         logger.error("Error restoring link and its performance data: %s", e, exc_info=True)
         flash(request, "An error occurred while restoring the link.", "danger")
@@ -1541,21 +1634,17 @@ def restore_link(request: Request, link_id: str):
         raise HTTPException(status_code=500, detail="Error redirecting after restoring link")
 
 @router.post("/links/{link_id}/delete-permanently", name="clusters_delete_link_permanently")
-def delete_link_permanently(request: Request, link_id: str):
+def delete_link_permanently(request: Request, link_id: ObjectId = Depends(link_object_id), user_id: ObjectId = Depends(require_user)):
     """
     Physically removes the link doc and performance data from DB.
-    Typically used after a 30-day grace period or user confirmation.
+    Used when the user purges it from the trash; otherwise the deletedAt TTL
+    indexes (db_client.py) remove it TRASH_RETENTION_DAYS after it was trashed.
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You need to log in to delete a link permanently.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        user_id = request.state.session["user_id"]
-        db = client["apimio"]
-        link_doc = db.links.find_one({
-            "_id": ObjectId(link_id),
+        link_doc = links_coll.find_one({
+            "_id": link_id,
             "deleted": True
-        })
+        }, {"clusterId": 1})
         if not link_doc:
             flash(request, "The link was not found or is not in trash.", "danger")
             raise HTTPException(status_code=404, detail="Link not found or not in trash.")
@@ -1565,12 +1654,10 @@ def delete_link_permanently(request: Request, link_id: str):
         raise HTTPException(status_code=500, detail="Error retrieving trashed link")
     
     try:
-        # Ensure the cluster belongs to this user
-        cluster = db.clusters.find_one({
-            "_id": link_doc["clusterId"],
-            "userId": ObjectId(user_id)
-        })
-        if not cluster:
+        # Ensure the cluster belongs to this user (a cluster's owner never changes,
+        # so the cached doc is enough)
+        cluster = get_cluster(link_doc["clusterId"])
+        if not cluster or cluster["userId"] != user_id:
             flash(request, "You do not have permission to delete this link permanently.", "danger")
             raise HTTPException(status_code=403, detail="This link's cluster does not belong to the current user.")
     except Exception as e:
@@ -1579,8 +1666,11 @@ def delete_link_permanently(request: Request, link_id: str):
         raise HTTPException(status_code=500, detail="Error verifying cluster")
     
     try:
-        db.link_performance.delete_many({"linkId": link_doc["_id"]})
-        db.links.delete_one({"_id": link_doc["_id"]})
+        # Performance data first, so a failure part-way leaves the link in the trash
+        write_in_order(
+            (perf_coll, pymongo.DeleteMany({"linkId": link_doc["_id"]}, namespace=perf_coll.full_name)),
+            (links_coll, pymongo.DeleteOne({"_id": link_doc["_id"]}, namespace=links_coll.full_name))
+        )
     except Exception as e:
         logger.error("Error deleting link permanently: %s", e, exc_info=True)
         flash(request, "An error occurred while deleting the link permanently.", "danger")
@@ -1595,35 +1685,27 @@ def delete_link_permanently(request: Request, link_id: str):
         raise HTTPException(status_code=500, detail="Error redirecting after deletion")
 
 @router.get("/trash/{domain}", response_class=HTMLResponse, name="clusters_view_trash")
-def view_trash(request: Request, domain: str):
+def view_trash(request: Request, domain: str, user_id: ObjectId = Depends(require_user)):
     """
     Show all trashed clusters and links for this user + domain.
     - Clusters: userId + domain + deleted=True
     - Links: userId + domain + deleted=True (the link's cluster must belong to the same user+domain)
     """
-    if not hasattr(request.state, "session") or "user_id" not in request.state.session:
-        flash(request, "You need to log in to view trashed items.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
     try:
-        user_id = request.state.session["user_id"]
-        db = client["apimio"]
-        # Find all clusters for this user and domain
-        all_domain_clusters = list(db.clusters.find({
-            "userId": ObjectId(user_id),
+        # Find all clusters for this user and domain in one query; the trashed ones
+        # are listed, and all of them scope the trashed links.
+        all_domain_clusters = list(clusters_coll.find({
+            "userId": user_id,
             "domain": domain
-        }, {"_id": 1, "deleted": 1}))
+        }, TRASH_CLUSTER_PROJECTION))
         cluster_ids = [c["_id"] for c in all_domain_clusters]
-        trashed_clusters = list(db.clusters.find({
-            "userId": ObjectId(user_id),
-            "domain": domain,
-            "deleted": True
-        }))
+        trashed_clusters = [c for c in all_domain_clusters if c.get("deleted")]
         trashed_links = []
         if cluster_ids:
-            trashed_links = list(db.links.find({
+            trashed_links = list(links_coll.find({
                 "clusterId": {"$in": cluster_ids},
                 "deleted": True
-            }))
+            }, TRASH_LINK_PROJECTION))
     except Exception as e:
         logger.error("Error retrieving trash data: %s", e, exc_info=True)
         flash(request, "No trashed clusters or links found for this domain.", "info")
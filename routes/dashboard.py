@@ -1,123 +1,175 @@
 import logging
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from bson import ObjectId
+from typing import Tuple
+from cachetools import TTLCache
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
 
-import google.oauth2.credentials
-from googleapiclient.discovery import build
-
-from fastapi import APIRouter, Request, Form, HTTPException
+from fastapi import APIRouter, Depends, Request, Form, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
-from starlette.templating import Jinja2Templates
 from routes.flash import flash, get_flashed_messages
+from routes.utils import LoginRequired, build_gsc_service, credentials_from_dict, require_user, templates
 
-from db_client import client
+from db_client import client, utc_now
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
-API_SERVICE_NAME = 'webmasters'
-API_VERSION = 'v3'
+db = client["apimio"]
+domain_coll = db["domain_properties"]
 
-@router.get("/properties", name="dashboard_sites_list", response_class=HTMLResponse)
-def sites_list(request: Request):
-    """
-    Renders the local domain properties after syncing from Google Search Console.
-    """
-    # Ensure session is available
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not initialized in request.state")
-        flash(request, "Session not available.", "danger")
-        raise HTTPException(status_code=500, detail="Session not available")
+# Runs the properties page's local domain read alongside its Search Console call.
+# Handlers are sync, so the overlap uses a small thread pool rather than asyncio.
+local_reads_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="dashboard-db")
 
-    # Check required session data
-    if 'credentials' not in request.state.session or 'user_id' not in request.state.session:
-        flash(request, "Authentication required. Please log in.", "warning")
-        return RedirectResponse(url=request.url_for("auth_authorize"))
+# Domain property fields shown on the properties page.
+DOMAIN_PROPERTY_PROJECTION = {"_id": 0, "siteUrl": 1, "active": 1, "permissionLevel": 1}
 
-    try:
-        creds_dict = request.state.session['credentials']
-        # Convert expiry from ISO string to datetime, if needed
-        if 'expiry' in creds_dict and isinstance(creds_dict['expiry'], str):
-            creds_dict['expiry'] = datetime.fromisoformat(creds_dict['expiry'])
-        creds = google.oauth2.credentials.Credentials(**creds_dict)
-    except Exception as e:
-        logger.error("Error processing credentials from session: %s", e, exc_info=True)
-        flash(request, "Error processing credentials.", "danger")
-        raise HTTPException(status_code=500, detail="Error processing credentials.")
+# In-process cache of each user's Search Console site list. Within the TTL a reload
+# of the properties page skips the Google call, and the sync below it, since the
+# domain properties were already synced from that same list.
+GSC_SITES_CACHE_TTL_SECONDS = 60
+_gsc_sites_cache = TTLCache(maxsize=1024, ttl=GSC_SITES_CACHE_TTL_SECONDS)
+_gsc_sites_cache_lock = threading.Lock()
 
+def _sync_domain_properties(user_oid: ObjectId, site_entries: list, local_domains: list) -> Tuple[list, bool]:
+    """
+    Syncs the user's domain properties with the GSC site list: listed sites are
+    upserted as active, sites no longer listed are marked inactive. Returns the
+    updated domain properties and whether every write succeeded; local_domains
+    (read with DOMAIN_PROPERTY_PROJECTION) is updated in place.
+    """
+    # 2. Build a set of siteUrls from GSC
+    gsc_site_urls = {site.get('siteUrl') for site in site_entries if site.get('siteUrl')}
+    local_state = {
+        doc["siteUrl"]: (doc.get("active"), doc.get("permissionLevel"))
+        for doc in local_domains if doc.get("siteUrl")
+    }
+    local_site_urls = set(local_state)
+
+    now = utc_now()
+    # 4. Upsert each site from GSC with active=True. Only new or changed sites are
+    #    written, so re-syncing an unchanged site list sends no writes at all.
+    ops = [
+        UpdateOne(
+            {"userId": user_oid, "siteUrl": site["siteUrl"]},
+            {
+                "$set": {
+                    "updatedAt": now,
+                    "active": True,
+                    "permissionLevel": site.get('permissionLevel', 'N/A')
+                },
+                "$setOnInsert": {"createdAt": now}
+            },
+            upsert=True
+        )
+        for site in site_entries
+        if site.get('siteUrl') and local_state.get(site["siteUrl"]) != (True, site.get('permissionLevel', 'N/A'))
+    ]
+    # 5. Mark removed sites as inactive (those not already marked)
+    removed_sites = local_site_urls - gsc_site_urls
+    newly_removed = [site_url for site_url in removed_sites if local_state[site_url] != (False, "N/A")]
+    if newly_removed:
+        ops.append(UpdateMany(
+            {"userId": user_oid, "siteUrl": {"$in": newly_removed}},
+            {"$set": {"active": False, "updatedAt": now, "permissionLevel": "N/A"}}
+        ))
+    # Sent as one unordered batch: each write is independent, so one failing does not stop the rest.
+    if ops:
+        try:
+            domain_coll.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                logger.error("Error syncing domain property (%s): %s", err["op"].get("q"), err.get("errmsg"))
+            return _find_domain_properties(user_oid), False
+        except Exception as e:
+            logger.error("Error syncing domain properties: %s", e, exc_info=True)
+            return _find_domain_properties(user_oid), False
+
+    # 6. Apply the writes to the domain properties read before the sync; every write
+    #    succeeded, so this matches what a re-fetch would return.
+    gsc_sites = {site["siteUrl"]: site for site in site_entries if site.get('siteUrl')}
+    for doc in local_domains:
+        site = gsc_sites.get(doc.get("siteUrl"))
+        if site is not None:
+            doc.update(active=True, permissionLevel=site.get('permissionLevel', 'N/A'))
+        elif doc.get("siteUrl") in removed_sites:
+            doc.update(active=False, permissionLevel="N/A")
+    local_domains.extend(
+        {"siteUrl": site_url, "active": True, "permissionLevel": site.get('permissionLevel', 'N/A')}
+        for site_url, site in gsc_sites.items() if site_url not in local_site_urls
+    )
+    return local_domains, True
+
+def _find_domain_properties(user_oid: ObjectId) -> list:
     try:
-        service = build(API_SERVICE_NAME, API_VERSION, credentials=creds, cache_discovery=False)
+        return list(domain_coll.find({"userId": user_oid}, DOMAIN_PROPERTY_PROJECTION))
     except Exception as e:
-        logger.error("Error building Google service: %s", e, exc_info=True)
-        flash(request, "Error connecting to Google Search Console.", "danger")
-        raise HTTPException(status_code=502, detail="Error connecting to Google service.")
+        logger.error("Error re-fetching local domains: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail="Error re-accessing local domain properties.")
 
-    try:
-        # 1. Fetch the list of sites from GSC
-        response = service.sites().list().execute()
-        site_entries = response.get('siteEntry', [])
-    except Exception as e:
-        logger.error("Error fetching site list from Google: %s", e, exc_info=True)
-        flash(request, "Error fetching site list from Google.", "danger")
-        raise HTTPException(status_code=502, detail="Error fetching site list from Google.")
+@router.get("/properties", name="dashboard_sites_list", response_class=HTMLResponse)
+def sites_list(request: Request, user_id: ObjectId = Depends(require_user)):
+    """
+    Renders the local domain properties after syncing from Google Search Console.
+    """
+    if 'credentials' not in request.state.session:
+        raise LoginRequired()
 
-    # 2. Build a set of siteUrls from GSC
-    gsc_site_urls = {site.get('siteUrl') for site in site_entries if site.get('siteUrl')}
+    # 3. Start fetching local domain data from the database; it does not depend on
+    #    the GSC response, so it runs while the site list is fetched.
+    local_domains_future = local_reads_executor.submit(
+        lambda: list(domain_coll.find({"userId": user_id}, DOMAIN_PROPERTY_PROJECTION))
+    )
 
-    # 3. Fetch local domain data from the database
-    user_id = request.state.session["user_id"]
-    db = client["apimio"]
-    domain_coll = db["domain_properties"]
-    try:
-        local_domains = list(domain_coll.find({"userId": ObjectId(user_id)}))
-        local_site_urls = {doc.get("siteUrl") for doc in local_domains if doc.get("siteUrl")}
-    except Exception as e:
-        logger.error("Error fetching local domains: %s", e, exc_info=True)
-        flash(request, "Error accessing local domain properties.", "danger")
-        raise HTTPException(status_code=500, detail="Error accessing local domain properties.")
+    with _gsc_sites_cache_lock:
+        site_entries = _gsc_sites_cache.get(user_id)
 
-    now = datetime.utcnow()
-    # 4. Upsert each site from GSC with active=True
-    for site in site_entries:
-        site_url = site.get('siteUrl')
-        if not site_url:
-            continue
-        perm_level = site.get('permissionLevel', 'N/A')
+    if site_entries is None:
         try:
-            domain_coll.update_one(
-                {"userId": ObjectId(user_id), "siteUrl": site_url},
-                {
-                    "$set": {
-                        "updatedAt": now,
-                        "active": True,
-                        "permissionLevel": perm_level
-                    },
-                    "$setOnInsert": {"createdAt": now}
-                },
-                upsert=True
-            )
+            # Converts the ISO expiry string and drops keys Credentials() does not accept.
+            creds = credentials_from_dict(request.state.session['credentials'])
         except Exception as e:
-            logger.error("Error upserting site %s: %s", site_url, e, exc_info=True)
+            logger.error("Error processing credentials from session: %s", e, exc_info=True)
+            flash(request, "Error processing credentials.", "danger")
+            raise HTTPException(status_code=500, detail="Error processing credentials.")
+
+        try:
+            service = build_gsc_service(creds)
+        except Exception as e:
+            logger.error("Error building Google service: %s", e, exc_info=True)
+            flash(request, "Error connecting to Google Search Console.", "danger")
+            raise HTTPException(status_code=502, detail="Error connecting to Google service.")
 
-    # 5. Mark removed sites as inactive
-    removed_sites = local_site_urls - gsc_site_urls
-    if removed_sites:
         try:
-            domain_coll.update_many(
-                {"userId": ObjectId(user_id), "siteUrl": {"$in": list(removed_sites)}},
-                {"$set": {"active": False, "updatedAt": now, "permissionLevel": "N/A"}}
-            )
+            # 1. Fetch the list of sites from GSC
+            response = service.sites().list().execute()
+            site_entries = response.get('siteEntry', [])
         except Exception as e:
-            logger.error("Error marking removed sites as inactive: %s", e, exc_info=True)
+            logger.error("Error fetching site list from Google: %s", e, exc_info=True)
+            flash(request, "Error fetching site list from Google.", "danger")
+            raise HTTPException(status_code=502, detail="Error fetching site list from Google.")
+        synced = False
+    else:
+        # Already synced from this list within the TTL.
+        synced = True
 
-    # 6. Re-fetch updated local domains
     try:
-        local_domains = list(domain_coll.find({"userId": ObjectId(user_id)}))
+        local_domains = local_domains_future.result()
     except Exception as e:
-        logger.error("Error re-fetching local domains: %s", e, exc_info=True)
-        raise HTTPException(status_code=500, detail="Error re-accessing local domain properties.")
+        logger.error("Error fetching local domains: %s", e, exc_info=True)
+        flash(request, "Error accessing local domain properties.", "danger")
+        raise HTTPException(status_code=500, detail="Error accessing local domain properties.")
+
+    if not synced:
+        local_domains, synced = _sync_domain_properties(user_id, site_entries, local_domains)
+        # A failed sync is retried on the next load rather than cached as done.
+        if synced:
+            with _gsc_sites_cache_lock:
+                _gsc_sites_cache[user_id] = site_entries
 
     # 7. Render the template with the local domains
     try:
@@ -131,15 +183,10 @@ def sites_list(request: Request):
         raise HTTPException(status_code=500, detail="Error rendering page.")
 
 @router.post("/properties/select", name="dashboard_select_site")
-def select_site(request: Request, site_url: str = Form(...)):
+def select_site(request: Request, site_url: str = Form(...), user_id: ObjectId = Depends(require_user)):
     """
     Stores the selected site in the session and updates the domain properties in the database.
     """
-    if not hasattr(request.state, 'session'):
-        logger.error("Session not initialized in request.state")
-        flash(request, "Session not available.", "danger")
-        raise HTTPException(status_code=500, detail="Session not available")
-
     chosen_site = site_url
     if not chosen_site:
         flash(request, "Please select a site.", "warning")
@@ -154,26 +201,20 @@ def select_site(request: Request, site_url: str = Form(...)):
         raise HTTPException(status_code=500, detail="Error storing selected site.")
 
     logger.info("User selected site: %s", chosen_site)
-    user_id = request.state.session.get("user_id")
-    if user_id:
-        db = client["apimio"]
-        domain_coll = db["domain_properties"]
-        now = datetime.utcnow()
-        try:
-            domain_coll.update_one(
-                {"userId": ObjectId(user_id), "siteUrl": chosen_site},
-                {
-                    "$set": {"updatedAt": now, "active": True},
-                    "$setOnInsert": {"userId": ObjectId(user_id), "siteUrl": chosen_site, "createdAt": now}
-                },
-                upsert=True
-            )
-        except Exception as e:
-            logger.error("Error updating domain for site %s: %s", chosen_site, e, exc_info=True)
-            flash(request, "Error updating domain information.", "danger")
-            raise HTTPException(status_code=500, detail="Error updating domain information.")
-    else:
-        logger.warning("No user_id in session; cannot update domain in database.")
+    now = utc_now()
+    try:
+        domain_coll.update_one(
+            {"userId": user_id, "siteUrl": chosen_site},
+            {
+                "$set": {"updatedAt": now, "active": True},
+                "$setOnInsert": {"userId": user_id, "siteUrl": chosen_site, "createdAt": now}
+            },
+            upsert=True
+        )
+    except Exception as e:
+        logger.error("Error updating domain for site %s: %s", chosen_site, e, exc_info=True)
+        flash(request, "Error updating domain information.", "danger")
+        raise HTTPException(status_code=500, detail="Error updating domain information.")
 
     # Redirect to the clusters list page
     try:
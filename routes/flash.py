@@ -1,32 +1,130 @@
+import base64
+import json
+import logging
 from fastapi import Request
-from typing import List
+from typing import List, Optional
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-FLASH_SESSION_KEY = "flash_messages"
+logger = logging.getLogger(__name__)
 
-def flash(request: Request, message: str, category: str = "info"):
+# Flash messages travel in their own short-lived cookie rather than the session, so
+# flashing or showing a message never loads or rewrites the session document.
+FLASH_COOKIE_NAME = "_flash"
+FLASH_COOKIE_MAX_AGE = 30
+# Browsers cap a cookie at about 4KB; the oldest messages are dropped beyond this.
+FLASH_COOKIE_MAX_BYTES = 3800
+
+# Set-Cookie values built once; append "; Secure" to the suffixes if using HTTPS.
+_COOKIE_PREFIX = f"{FLASH_COOKIE_NAME}=".encode("latin-1")
+_COOKIE_SUFFIX = f"; Max-Age={FLASH_COOKIE_MAX_AGE}; Path=/; HttpOnly; SameSite=Lax".encode("latin-1")
+_COOKIE_DELETE = _COOKIE_PREFIX + b"; Max-Age=0; Path=/; HttpOnly; SameSite=Lax"
+
+
+class FlashMessages:
     """
-    Stores a flash message in the session.
+    request.state.flash: the messages from the request's flash cookie (decoded on
+    first use) plus any flashed while handling it. changed tells the middleware
+    to rewrite or clear the cookie.
     """
-    if not hasattr(request.state, "session") or request.state.session is None:
-        raise RuntimeError("Session middleware is not properly configured.")
-    
-    session = request.state.session
 
-    flash_messages = session.get(FLASH_SESSION_KEY, [])
-    flash_messages.append({"message": message, "category": category})
-    
-    session[FLASH_SESSION_KEY] = flash_messages  # Update session storage
+    def __init__(self, cookie: Optional[bytes]):
+        self.cookie = cookie
+        self._messages: Optional[List[dict]] = None
+        self.changed = False
+
+    @property
+    def messages(self) -> List[dict]:
+        if self._messages is None:
+            self._messages = decode_flash_cookie(self.cookie) if self.cookie else []
+        return self._messages
+
+    @messages.setter
+    def messages(self, value: List[dict]):
+        self._messages = value
+        self.changed = True
+
+
+def encode_flash_cookie(messages: List[dict]) -> bytes:
+    """Serialize messages to a cookie value: compact JSON, base64url encoded."""
+    while True:
+        value = base64.urlsafe_b64encode(json.dumps(messages, separators=(",", ":")).encode())
+        if len(value) <= FLASH_COOKIE_MAX_BYTES or len(messages) <= 1:
+            return value
+        messages = messages[1:]
+
+
+def decode_flash_cookie(value: bytes) -> List[dict]:
+    """Parse a flash cookie value; a malformed cookie reads as no messages."""
+    try:
+        messages = json.loads(base64.urlsafe_b64decode(value))
+    except ValueError:
+        logger.warning("Ignoring malformed flash cookie")
+        return []
+    return messages if isinstance(messages, list) else []
+
+
+def _flash_messages(request: Request) -> FlashMessages:
+    flash_messages = getattr(request.state, "flash", None)
+    if flash_messages is None:
+        raise RuntimeError("Flash middleware is not properly configured.")
+    return flash_messages
+
+
+def flash(request: Request, message: str, category: str = "info"):
+    """
+    Stores a flash message for the next page rendered (in this or a following request).
+    """
+    flash_messages = _flash_messages(request)
+    flash_messages.messages = flash_messages.messages + [{"message": message, "category": category}]
 
 def get_flashed_messages(request: Request) -> List[dict]:
     """
-    Retrieves and clears flash messages from the session.
+    Retrieves and clears the flash messages.
+    """
+    flash_messages = _flash_messages(request)
+    messages = flash_messages.messages
+    if messages:
+        flash_messages.messages = []  # Clear messages after retrieval
+    return messages
+
+
+class FlashCookieMiddleware:
+    """
+    Pure ASGI middleware that puts a FlashMessages for the request's flash cookie
+    into request.state.flash and, when the messages changed, sets or clears the
+    cookie as the response starts.
     """
-    if not hasattr(request.state, "session") or request.state.session is None:
-        raise RuntimeError("Session middleware is not properly configured.")
-    
-    session = request.state.session
 
-    messages = session.get(FLASH_SESSION_KEY, [])
-    session[FLASH_SESSION_KEY] = []  # Clear messages after retrieval
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Only the one cookie is needed, so scan the raw bytes instead of parsing them all.
+        cookie = None
+        for key, value in scope["headers"]:
+            if key == b"cookie":
+                for part in value.split(b";"):
+                    part = part.strip()
+                    if part.startswith(_COOKIE_PREFIX):
+                        cookie = part[len(_COOKIE_PREFIX):] or None
+                        break
+                break
+
+        flash_messages = FlashMessages(cookie)
+        scope.setdefault("state", {})["flash"] = flash_messages
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start" and flash_messages.changed:
+                headers = MutableHeaders(scope=message)
+                if flash_messages.messages:
+                    headers.raw.append((b"set-cookie", _COOKIE_PREFIX + encode_flash_cookie(flash_messages.messages) + _COOKIE_SUFFIX))
+                elif cookie is not None:
+                    headers.raw.append((b"set-cookie", _COOKIE_DELETE))
+            await send(message)
 
-    return messages if messages else []  # Ensure an empty list is returned
+        await self.app(scope, receive, send_wrapper)
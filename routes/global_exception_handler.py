@@ -1,13 +1,23 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, HTMLResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
+from routes.flash import flash
+from routes.utils import LoginRequired, templates
 import logging
 
 logger = logging.getLogger(__name__)
-templates = Jinja2Templates(directory="templates")
+
+# The error page is rendered on every HTML error response, so its compiled
+# template is looked up once here rather than through the loader per response.
+ERROR_TEMPLATE = templates.get_template("error.html")
 
 def register_global_exception_handlers(app: FastAPI):
+    @app.exception_handler(LoginRequired)
+    async def login_required_handler(request: Request, exc: LoginRequired):
+        # Raised by the require_user / require_selected_site dependencies.
+        flash(request, exc.message, "warning")
+        return RedirectResponse(url=request.url_for("auth_authorize"))
+
     @app.exception_handler(StarletteHTTPException)
     async def global_http_exception_handler(request: Request, exc: StarletteHTTPException):
         # Log the exception details for internal diagnostics.
@@ -17,15 +27,14 @@ def register_global_exception_handlers(app: FastAPI):
         accept_header = request.headers.get("accept", "")
         if "text/html" in accept_header:
             # Render a friendly HTML error page.
-            return templates.TemplateResponse(
-                "error.html",
-                {
-                    "request": request,
-                    "message": "Oops! Something went wrong.",
-                    "status_code": exc.status_code,
+            return HTMLResponse(
+                ERROR_TEMPLATE.render(
+                    request=request,
+                    message="Oops! Something went wrong.",
+                    status_code=exc.status_code,
                     # You can choose to hide exc.detail if needed.
-                    "detail": exc.detail  
-                },
+                    detail=exc.detail
+                ),
                 status_code=exc.status_code
             )
         else:
@@ -1,14 +1,12 @@
 import logging
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import HTMLResponse
-from starlette.templating import Jinja2Templates
 from routes.flash import flash, get_flashed_messages
+from routes.utils import templates
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-templates = Jinja2Templates(directory="templates")
-
 @router.get("/", response_class=HTMLResponse)
 def index(request: Request):
     logger.info("Rendering index page from main route")
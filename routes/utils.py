@@ -1,4 +1,34 @@
-from datetime import datetime
+import os
+import logging
+import threading
+from datetime import datetime, timezone
+
+import jinja2
+import google.oauth2.credentials
+import google_auth_httplib2
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
+from bson import ObjectId
+from bson.errors import InvalidId
+from typing import Optional
+from fastapi import Depends, HTTPException, Query, Request
+from starlette.templating import Jinja2Templates
+
+logger = logging.getLogger(__name__)
+
+# Shared Jinja2 templates for all route modules. Compiled templates are kept in a
+# bytecode cache across processes; outside development the source files are not
+# re-checked for changes on every render.
+templates = Jinja2Templates(env=jinja2.Environment(
+    loader=jinja2.FileSystemLoader("templates"),
+    autoescape=True,
+    auto_reload=(os.getenv("ENV", "development") == "development"),
+    bytecode_cache=jinja2.FileSystemBytecodeCache()
+))
+
+# Keys of the session credentials dict that Credentials() accepts as keyword arguments.
+CREDENTIALS_KWARGS = ('token', 'refresh_token', 'token_uri', 'client_id', 'client_secret', 'scopes')
 
 def credentials_to_dict(credentials):
     return {
@@ -8,5 +38,98 @@ def credentials_to_dict(credentials):
         'client_id': credentials.client_id,
         'client_secret': credentials.client_secret,
         'scopes': credentials.scopes,
-        'expiry': credentials.expiry.isoformat() if credentials.expiry else None
+        'expiry': credentials.expiry.isoformat() if credentials.expiry else None,
+        # Epoch seconds of the expiry (credentials.expiry is naive UTC), for cheap validity checks.
+        'expiry_ts': credentials.expiry.replace(tzinfo=timezone.utc).timestamp() if credentials.expiry else None
     }
+
+def credentials_from_dict(creds_dict):
+    """
+    Builds Credentials from a session credentials dict, ignoring keys Credentials()
+    does not accept (e.g. expiry_ts) and parsing the ISO expiry string.
+    """
+    kwargs = {key: creds_dict[key] for key in CREDENTIALS_KWARGS if key in creds_dict}
+    expiry = creds_dict.get('expiry')
+    if isinstance(expiry, str):
+        expiry = datetime.fromisoformat(expiry)
+    return google.oauth2.credentials.Credentials(expiry=expiry, **kwargs)
+
+GSC_API_SERVICE_NAME = 'webmasters'
+GSC_API_VERSION = 'v3'
+# The Search Console discovery document ships with google-api-python-client; read it once.
+GSC_DISCOVERY_DOC = discovery_cache.get_static_doc(GSC_API_SERVICE_NAME, GSC_API_VERSION)
+
+_thread_http = threading.local()
+
+def build_gsc_service(creds):
+    """
+    Builds a Search Console client for creds from the cached discovery document.
+    httplib2.Http is not thread-safe, so each thread keeps its own; the services
+    a thread builds reuse its keep-alive connections to Google.
+    """
+    http = getattr(_thread_http, "http", None)
+    if http is None:
+        http = _thread_http.http = build_http()
+    return build_from_document(GSC_DISCOVERY_DOC, http=google_auth_httplib2.AuthorizedHttp(creds, http=http))
+
+class LoginRequired(Exception):
+    """
+    Raised by the session dependencies below when the request has no logged-in user
+    (or no selected site). The handler registered in global_exception_handler.py
+    flashes the message and redirects to the OAuth flow.
+    """
+    def __init__(self, message: str = "Authentication required. Please log in."):
+        super().__init__(message)
+        self.message = message
+
+def require_user(request: Request) -> ObjectId:
+    """
+    Dependency returning the logged-in user's id as an ObjectId.
+    FastAPI resolves it once per request, however many dependencies share it.
+    """
+    session = getattr(request.state, "session", None)
+    if session is None:
+        logger.error("Session not initialized in request.state")
+        raise HTTPException(status_code=500, detail="Session not available")
+    user_id = session.get("user_id")
+    if not user_id:
+        raise LoginRequired()
+    # Stored at login alongside the hex user_id; older sessions only have the string.
+    user_oid = session.get("user_oid")
+    if isinstance(user_oid, ObjectId):
+        return user_oid
+    try:
+        return ObjectId(user_id)
+    except (InvalidId, TypeError):
+        logger.warning("Invalid user_id in session: %r", user_id)
+        raise LoginRequired()
+
+def require_selected_site(request: Request, user_id: ObjectId = Depends(require_user)) -> str:
+    """
+    Dependency returning the site selected on the properties page, for a logged-in user.
+    """
+    domain = request.state.session.get("selected_site")
+    if not domain:
+        raise LoginRequired("Session expired or invalid. Please log in again.")
+    return domain
+
+def _path_object_id(value: str, kind: str) -> ObjectId:
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail=f"Invalid {kind} id.") from None
+
+def cluster_object_id(cluster_id: str) -> ObjectId:
+    """
+    Dependency parsing the {cluster_id} path parameter into an ObjectId once, so
+    malformed ids are answered with a 400 before any handler or database code runs.
+    """
+    return _path_object_id(cluster_id, "cluster")
+
+def link_object_id(link_id: str) -> ObjectId:
+    """Dependency parsing the {link_id} path parameter; see cluster_object_id."""
+    return _path_object_id(link_id, "link")
+
+def after_object_id(after: Optional[str] = Query(None)) -> Optional[ObjectId]:
+    """Dependency parsing the optional ?after= paging cursor; see cluster_object_id."""
+    return _path_object_id(after, "cursor") if after else None
@@ -21,25 +21,23 @@ document.addEventListener("DOMContentLoaded", function () {
       }
   }
 
-  // For deleting clusters
-  document.querySelectorAll(".delete-btn").forEach((btn) => {
-      btn.addEventListener("click", function (event) {
-          openConfirmModal(event, "This will move the cluster to trash. You have 30 days to restore it before it is permanently deleted. Continue?");
-      });
-  });
-
-  // For deleting links
-  document.querySelectorAll(".delete-link-btn").forEach((btn) => {
-      btn.addEventListener("click", function (event) {
-          openConfirmModal(event, "This will move the link to trash. You have 30 days to restore it before it is permanently deleted. Continue?");
-      });
-  });
+  // Delegated from the document, so rows added later (HTMX "load more") are covered too.
+  const confirmMessages = {
+      // For deleting clusters
+      ".delete-btn": "This will move the cluster to trash. You have 30 days to restore it before it is permanently deleted. Continue?",
+      // For deleting links
+      ".delete-link-btn": "This will move the link to trash. You have 30 days to restore it before it is permanently deleted. Continue?",
+      // For refreshing GSC data
+      ".refresh-gsc-btn": "Refresh GSC data for this link?"
+  };
 
-  // For refreshing GSC data
-  document.querySelectorAll(".refresh-gsc-btn").forEach((btn) => {
-      btn.addEventListener("click", function (event) {
-          openConfirmModal(event, "Refresh GSC data for this link?");
-      });
+  document.addEventListener("click", function (event) {
+      for (const [selector, message] of Object.entries(confirmMessages)) {
+          if (event.target.closest(selector)) {
+              openConfirmModal(event, message);
+              return;
+          }
+      }
   });
 
   document.getElementById("confirm-delete").addEventListener("click", confirmDelete);